@@ -0,0 +1,408 @@
+"""
+Offline load test: runs the real bot (build_app(), real handlers, real
+Postgres) against a local fake of the Telegram Bot API and measures how
+fast it gets through synthetic traffic.
+
+    BENCH_DATABASE_URL=postgres://localhost/bot_bench python benchmark.py --fresh
+
+Scenarios, in order:
+- start:     a flood of /start from new users
+- join:      chat_member updates for those users joining each required
+             channel, which the bot mirrors into channel_members
+- verify:    the same users tapping Verify; answered from the mirror, so the
+             run fails if it makes a single getChatMember call
+- broadcast: /broadcast to --broadcast-users seeded users
+
+Latency is per update, from the moment it was due (see --rate) until every
+handler group finished, so queueing inside the bot counts. For the broadcast
+it is the time from /broadcast until each user's message reached the fake
+API. Every run appends one JSON line to --out and is compared with the
+previous line there.
+
+Use a throwaway database: --fresh empties users and broadcast_jobs. The fake
+API answers with --api-latency-ms (+ up to --api-jitter-ms) and rejects
+--retry-after-rate of all sends with a 429.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import time
+import zlib
+from datetime import datetime, timezone
+
+from telegram import Update
+
+from metrics import LatencyStats
+
+BENCH_ADMIN_ID = 1
+START_USER_BASE = 1_000_000_000
+BROADCAST_USER_BASE = 2_000_000_000
+SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendMediaGroup",
+    "copyMessage", "copyMessages", "forwardMessage",
+}
+
+
+# ---------- Fake Bot API ----------
+def fake_channel_id(ident: str) -> int:
+    """The same id for a channel on every run, as resolved ids stay in the database."""
+    return -1_000_000_000_000 - zlib.crc32(ident.lower().encode())
+
+
+class FakeBotAPI:
+    """Just enough of the Bot API for every call the bot makes."""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, retry_after_rate: float, retry_after: int):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.calls: dict[str, int] = {}
+        self.rejected = 0
+        self.deliveries: list[tuple[int, float]] = []  # (chat_id, monotonic arrival) of accepted sends
+        self._message_id = 0
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def answer(self, method: str, params: dict) -> tuple[int, dict]:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = params.get("chat_id", "")
+        chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else 0  # '@channel' for getChatMember
+        if method in SEND_METHODS:
+            if random.random() < self.retry_after_rate:
+                self.rejected += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            self.deliveries.append((chat_id, time.monotonic()))
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getChat":
+            ident = params["chat_id"]
+            name = ident.lstrip("@")
+            result = {"id": fake_channel_id(ident), "type": "channel", "title": name, "username": name}
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "u"}}
+        elif method == "sendMediaGroup":
+            result = [self._message(chat_id, photo=[]) for _ in json.loads(params.get("media", "[]"))]
+        elif method == "copyMessages":
+            result = [{"message_id": self._message(chat_id)["message_id"]}
+                      for _ in json.loads(params.get("message_ids", "[]"))]
+        elif method.startswith(("send", "copy", "forward", "edit")):
+            result = self._message(chat_id, text=params.get("text", ""))
+        else:
+            result = True  # answerCallbackQuery, setMyCommands, deleteWebhook, ...
+        return 200, {"ok": True, "result": result}
+
+    async def start(self, port: int):
+        from tornado import httpserver, web
+
+        fake = self
+
+        class Handler(web.RequestHandler):
+            async def post(self, _token: str, method: str):
+                params = {k: self.get_body_argument(k) for k in self.request.body_arguments}
+                if not params and self.request.body:
+                    params = json.loads(self.request.body)
+                await asyncio.sleep(fake.latency + random.random() * fake.jitter)
+                status, body = fake.answer(method, params)
+                self.set_status(status)
+                self.set_header("Content-Type", "application/json")
+                self.finish(json.dumps(body))
+
+        server = httpserver.HTTPServer(web.Application([(r"/bot([^/]+)/(\w+)", Handler)]))
+        server.listen(port, "127.0.0.1")
+        return server
+
+
+# ---------- Synthetic updates ----------
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+
+def start_update(update_id: int, uid: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": _user(uid),
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def chat_member_update(update_id: int, uid: int, channel: str) -> dict:
+    """`uid` joining `channel` ('@name'), as a channel admin bot sees it."""
+    name = channel.lstrip("@")
+    return {
+        "update_id": update_id,
+        "chat_member": {
+            "chat": {"id": fake_channel_id(channel), "type": "channel", "title": name, "username": name},
+            "from": _user(uid),
+            "date": int(time.time()),
+            "old_chat_member": {"status": "left", "user": _user(uid)},
+            "new_chat_member": {"status": "member", "user": _user(uid)},
+        },
+    }
+
+
+def command_update(update_id: int, uid: int, text: str) -> dict:
+    update = start_update(update_id, uid)
+    command = text.split()[0]
+    update["message"].update(text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+    return update
+
+
+def callback_update(update_id: int, uid: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": 42, "is_bot": True, "first_name": "Bench"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+# ---------- Scenarios ----------
+async def feed(app, updates: list[dict], rate: float) -> dict:
+    """Processes updates the way Application does, `rate` per second (0 = all at once)."""
+    stats = LatencyStats(window=len(updates))
+    started = time.perf_counter()
+
+    async def one(i: int, data: dict):
+        due = started + (i / rate if rate else 0)
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = Update.de_json(data, app.bot)
+        await app.update_processor.process_update(update, app.process_update(update))
+        stats.observe((time.perf_counter() - due) * 1000)
+
+    await asyncio.gather(*[one(i, u) for i, u in enumerate(updates)])
+    return _result(stats, len(updates), time.perf_counter() - started)
+
+
+def _result(stats: LatencyStats, n: int, elapsed: float) -> dict:
+    return {
+        "n": n,
+        "seconds": round(elapsed, 3),
+        "per_second": round(n / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(stats.percentile(50), 1),
+        "p95_ms": round(stats.percentile(95), 1),
+        "p99_ms": round(stats.percentile(99), 1),
+        "max_ms": round(stats.max_ms, 1),
+    }
+
+
+async def run_broadcast_scenario(app, fake: FakeBotAPI, n_users: int) -> dict:
+    import db
+
+    seeded = datetime.now(timezone.utc)
+    ids = range(BROADCAST_USER_BASE, BROADCAST_USER_BASE + n_users)
+    for i in range(0, n_users, 5000):
+        await db.upsert_users_bulk([(uid, f"user{uid}", seeded) for uid in ids[i:i + 5000]])
+    total = await db.count_users()
+
+    fake.deliveries.clear()
+    started = time.monotonic()
+    await feed(app, [command_update(1, BENCH_ADMIN_ID, "/broadcast benchmark")], rate=0)
+    job = (await db.list_broadcast_jobs(limit=1))[0]
+    while job["status"] == "running":
+        await asyncio.sleep(0.5)
+        job = await db.get_broadcast_job(job["id"])
+
+    stats = LatencyStats(window=len(fake.deliveries))
+    last = started
+    for chat_id, arrived in fake.deliveries:
+        if chat_id != BENCH_ADMIN_ID:
+            stats.observe((arrived - started) * 1000)
+            last = max(last, arrived)
+    result = _result(stats, stats.count, last - started)
+    result.update(audience=total, status=job["status"], sent=job["sent"], failed=job["failed"], skipped=job["skipped"])
+    return result
+
+
+# ---------- Reporting ----------
+def _git_rev() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _previous_run(path: str) -> dict | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+
+def report(run: dict, previous: dict | None) -> None:
+    for name, r in run["scenarios"].items():
+        line = (
+            f"{name:>9}: {r['n']} in {r['seconds']:.2f}s ({r['per_second']:.1f}/s) "
+            f"| p50 {r['p50_ms']:.1f} | p95 {r['p95_ms']:.1f} | p99 {r['p99_ms']:.1f} ms"
+        )
+        before = (previous or {}).get("scenarios", {}).get(name)
+        if before and before["per_second"]:
+            line += (
+                f"  [vs {previous.get('git_rev') or 'previous'}: "
+                f"{r['per_second'] / before['per_second'] - 1:+.0%} /s, p95 {r['p95_ms'] - before['p95_ms']:+.1f} ms]"
+            )
+        print(line)
+    print(f"Bot API calls: {run['api_calls']} ({run['api_rejected']} answered with 429)")
+
+
+# ---------- Main ----------
+async def bench(args) -> dict:
+    fake = FakeBotAPI(args.api_latency_ms, args.api_jitter_ms, args.retry_after_rate, args.retry_after)
+    server = await fake.start(args.api_port)
+
+    import asyncpg
+    import main as bot
+    from writebehind import user_buffer
+
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    if args.fresh:
+        con = await asyncpg.connect(os.environ["DATABASE_URL"])
+        try:
+            await con.execute("TRUNCATE users, broadcast_jobs CASCADE")
+        except asyncpg.UndefinedTableError:
+            pass  # first run, init_db creates them
+        finally:
+            await con.close()
+
+    app = bot.build_app()
+    await app.initialize()
+    await bot.on_startup(app)
+    # on_startup does this in the background; chat_member updates need the ids
+    await bot.resolve_channel_ids(app.bot)
+
+    scenarios = {}
+    try:
+        uids = range(START_USER_BASE, START_USER_BASE + args.users)
+        if args.starts:
+            updates = [start_update(i, uids[i % len(uids)]) for i in range(args.starts)]
+            scenarios["start"] = await feed(app, updates, args.rate)
+            await user_buffer.flush()
+        if args.verifies:
+            channels = await bot.settings_cache.channels()
+            updates = [chat_member_update(i, uid, ch) for i, (uid, ch) in enumerate(
+                (uid, ch) for uid in uids for ch in channels)]
+            scenarios["join"] = await feed(app, updates, args.rate)
+            await user_buffer.flush()
+
+            checks_before = fake.calls.get("getChatMember", 0)
+            updates = [callback_update(i, uids[i % len(uids)], "verify") for i in range(args.verifies)]
+            scenarios["verify"] = await feed(app, updates, args.rate)
+            checks = fake.calls.get("getChatMember", 0) - checks_before
+            scenarios["verify"]["get_chat_member_calls"] = checks
+            if checks:
+                raise RuntimeError(
+                    f"Verify made {checks} getChatMember calls: the channel_members mirror wasn't used"
+                )
+        if args.broadcast_users:
+            scenarios["broadcast"] = await run_broadcast_scenario(app, fake, args.broadcast_users)
+    finally:
+        await bot.on_shutdown(app)
+        await app.shutdown()
+        server.stop()
+
+    return {
+        "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_rev": _git_rev(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "verbose")},
+        "scenarios": scenarios,
+        "api_calls": sum(fake.calls.values()),
+        "api_calls_by_method": fake.calls,
+        "api_rejected": fake.rejected,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--starts", type=int, default=5000, help="/start updates (0 skips)")
+    parser.add_argument("--verifies", type=int, default=5000, help="Verify taps (0 skips)")
+    parser.add_argument("--users", type=int, default=5000, help="distinct users sending them")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second (0 = all at once)")
+    parser.add_argument("--broadcast-users", type=int, default=100_000, help="broadcast audience (0 skips)")
+    parser.add_argument("--broadcast-rate", type=float, default=1000, help="BROADCAST_RATE for the run")
+    parser.add_argument(
+        "--outbound-rate", type=float, default=0,
+        help="OUTBOUND_GLOBAL_RATE and per-chat rates for the run (0 = --broadcast-rate)",
+    )
+    parser.add_argument("--api-latency-ms", type=float, default=30)
+    parser.add_argument("--api-jitter-ms", type=float, default=20)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="fraction of sends answered 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in those 429s")
+    parser.add_argument("--api-port", type=int, default=8999)
+    parser.add_argument("--fresh", action="store_true", help="empty users and broadcast_jobs first")
+    parser.add_argument("--out", default="benchmark_results.jsonl")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if not database_url:
+        # never DATABASE_URL: --fresh and the seeded users must not hit a real bot's database
+        raise SystemExit("Set BENCH_DATABASE_URL to a throwaway Postgres database")
+
+    outbound_rate = args.outbound_rate or args.broadcast_rate
+    # config.py reads these at import time
+    os.environ.update(
+        DATABASE_URL=database_url,
+        BOT_API_URL=f"http://127.0.0.1:{args.api_port}",
+        BOT_TOKEN="123456:BENCH",
+        MAIN_ADMIN_ID=str(BENCH_ADMIN_ID),
+        BROADCAST_RATE=str(args.broadcast_rate),
+        # the outbound scheduler would otherwise cap every scenario at Telegram's
+        # 30 msg/s; the fake API enforces no limits, so measure the bot instead
+        OUTBOUND_GLOBAL_RATE=str(outbound_rate),
+        OUTBOUND_PRIVATE_CHAT_RATE=str(outbound_rate),
+        OUTBOUND_GROUP_CHAT_RATE=str(outbound_rate),
+        CLUSTER_MODE="false",
+        METRICS_PORT="0",
+    )
+    os.environ.setdefault("REQUIRED_CHANNELS", "@bench_a,@bench_b")
+
+    previous = _previous_run(args.out)
+    run = asyncio.run(bench(args))
+    report(run, previous)
+    with open(args.out, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+    print(f"Saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
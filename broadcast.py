@@ -0,0 +1,568 @@
+import asyncio
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from typing import AsyncIterable, Awaitable, Callable, Iterable
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from config import (
+    BROADCAST_RATE,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_MAX_RETRIES,
+    BROADCAST_BATCH_SIZE,
+    BROADCAST_SHARD_LEASE,
+    BROADCAST_STATUS_INTERVAL,
+    BROADCAST_OFF_PEAK,
+    REPLICA_ID,
+)
+from db import (
+    claim_broadcast_shard,
+    release_broadcast_shards,
+    save_broadcast_progress,
+    finish_broadcast_shard,
+    iter_user_id_pages,
+)
+from writebehind import stats_buffer
+from metrics import broadcast_messages
+from tasks import StatusMessage, task_runner
+from outbound import BULK
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token-bucket limiter shared by every sender of a broadcast.
+    The refill rate adapts: a RetryAfter halves it and pauses everyone,
+    successful sends slowly bring it back up to `max_rate`.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None, min_rate: float = 1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        # The lock keeps waiters in FIFO order, so nobody starves.
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, retry_after: float) -> None:
+        """Pause all senders for `retry_after` seconds and lower the rate."""
+        resume_at = time.monotonic() + retry_after
+        self._paused_until = max(self._paused_until, resume_at)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def reward(self) -> None:
+        """Additive increase back towards `max_rate` after a successful send."""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 200)
+
+
+class BroadcastResult:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0  # unreachable, see below
+        self.unreachable: list[tuple[int, str]] = []  # (user_id, users.status)
+        self.receipts: list[tuple[int, list[int] | None, str | None]] = []  # (user_id, message_ids, error)
+        self.started = time.monotonic()
+        self.finished: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Measured throughput in messages per second."""
+        elapsed = self.elapsed
+        return (self.sent + self.failed + self.skipped) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"✅ Sent: {self.sent} | ❌ Failed: {self.failed} | 🚫 Skipped: {self.skipped} "
+            f"| ⚡ {self.rate:.1f} msg/s"
+        )
+
+
+class ProgressMeter:
+    """
+    Job-wide send rate over the last `window` seconds, from the job's
+    counters as they come back after each batch (so every shard counts),
+    and the ETA that rate gives.
+    """
+
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self._samples: deque[tuple[float, int]] = deque()  # (monotonic, processed)
+
+    def observe(self, processed: int) -> None:
+        now = time.monotonic()
+        self._samples.append((now, processed))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    @property
+    def rate(self) -> float:
+        if len(self._samples) < 2:
+            return 0.0
+        (t0, n0), (t1, n1) = self._samples[0], self._samples[-1]
+        return (n1 - n0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def eta(self, remaining: int) -> str:
+        if remaining <= 0:
+            return "0s"
+        rate = self.rate
+        if rate <= 0:
+            return "?"
+        seconds = int(remaining / rate)
+        if seconds >= 3600:
+            return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+def unreachable_status(e: TelegramError) -> str | None:
+    """Maps errors meaning we can never reach this user to a users.status value."""
+    msg = str(e).lower()
+    if isinstance(e, Forbidden):
+        return "deactivated" if "deactivated" in msg else "blocked"
+    if isinstance(e, BadRequest) and "chat not found" in msg:
+        return "not_found"
+    return None
+
+
+def _message_ids(sent: object) -> list[int] | None:
+    """Ids of what a send_*/copy_* call delivered: a Message, a MessageId or a tuple of MessageIds."""
+    if isinstance(sent, (list, tuple)):
+        return [m.message_id for m in sent]
+    message_id = getattr(sent, "message_id", None)
+    return None if message_id is None else [message_id]
+
+
+async def _deliver(
+    uid: int,
+    send: Callable[[int], Awaitable[object]],
+    bucket: TokenBucket,
+    max_retries: int,
+) -> tuple[str, list[int] | None, str | None]:
+    """
+    Returns (outcome, message_ids, error): outcome is 'sent', 'failed', or an
+    unreachable status for users.status; error is the exception class.
+    """
+    error = None
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            sent = await send(uid)
+            bucket.reward()
+            return "sent", _message_ids(sent), None
+        except RetryAfter as e:
+            logger.warning(f"Flood limit hit while broadcasting, pausing {e.retry_after}s")
+            bucket.penalize(float(e.retry_after))
+            error = type(e).__name__
+        except (BadRequest, Forbidden) as e:
+            # Blocked the bot, deleted account, bad chat id... retrying won't help
+            logger.debug(f"Broadcast to {uid} failed permanently: {e}")
+            return unreachable_status(e) or "failed", None, type(e).__name__
+        except NetworkError as e:
+            logger.debug(f"Broadcast to {uid} hit a network error (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(min(30, 2 ** attempt))
+            error = type(e).__name__
+        except Exception as e:
+            logger.warning(f"Broadcast to {uid} failed: {e}")
+            return "failed", None, type(e).__name__
+    return "failed", None, error
+
+
+async def run_broadcast(
+    user_ids: Iterable[int] | AsyncIterable[int],
+    send: Callable[[int], Awaitable[object]],
+    *,
+    rate: float = BROADCAST_RATE,
+    concurrency: int = BROADCAST_CONCURRENCY,
+    max_retries: int = BROADCAST_MAX_RETRIES,
+    bucket: TokenBucket | None = None,
+) -> BroadcastResult:
+    """
+    Calls `send(uid)` for every user through a pool of `concurrency` senders,
+    all drawing from one token bucket. `send` should raise on failure.
+    `user_ids` may be an async iterable and is consumed lazily, only as fast as the senders drain the queue.
+    Pass `bucket` to keep the adapted rate across consecutive calls.
+    """
+    bucket = bucket or TokenBucket(rate)
+    result = BroadcastResult()
+    queue: asyncio.Queue[int | None] = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            uid = await queue.get()
+            if uid is None:
+                return
+            outcome, message_ids, error = await _deliver(uid, send, bucket, max_retries)
+            broadcast_messages.inc(outcome)  # send rate = rate(bot_broadcast_messages_total)
+            stats_buffer.incr(f"broadcast_{outcome}")
+            result.receipts.append((uid, message_ids, error))
+            if outcome == "sent":
+                result.sent += 1
+            elif outcome == "failed":
+                result.failed += 1
+            else:
+                result.skipped += 1
+                result.unreachable.append((uid, outcome))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        if isinstance(user_ids, AsyncIterable):
+            async for uid in user_ids:
+                await queue.put(uid)
+        else:
+            for uid in user_ids:
+                await queue.put(uid)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+        result.finished = time.monotonic()
+
+    logger.debug(f"Broadcast batch finished in {result.elapsed:.1f}s: {result.summary()}")
+    return result
+
+
+# ---------- Durable jobs ----------
+# copy_messages takes at most 100 ids
+MAX_COPIED_MESSAGES = 100
+
+
+def broadcast_payload(reply: Message | None, text: str, message_ids: list[int] | None = None) -> dict:
+    """
+    Serializable description of what to send, stored with the job. `text`
+    is HTML. A reply without text is copied as it is (one message, or the
+    album/range in `message_ids`), keeping its formatting and album grouping;
+    with text, the replied media is sent with `text` as its caption.
+    """
+    if reply and not text:
+        return {"kind": "copy", "from_chat_id": reply.chat_id, "message_ids": message_ids or [reply.message_id]}
+    if reply:
+        if reply.photo:
+            return {"kind": "photo", "file_id": reply.photo[-1].file_id, "text": text, "parse_mode": "HTML"}
+        if reply.video:
+            return {"kind": "video", "file_id": reply.video.file_id, "text": text, "parse_mode": "HTML"}
+        if reply.document:
+            return {"kind": "document", "file_id": reply.document.file_id, "text": text, "parse_mode": "HTML"}
+        # fallback to text if unknown media
+        return {"kind": "text", "text": text or "(no content)", "parse_mode": "HTML"}
+    return {"kind": "text", "text": text or "(empty broadcast)", "parse_mode": "HTML"}
+
+
+_OPTION = re.compile(r"\s*(joined_after|active|verified|messages|at|spread)=(\S+)")
+_DURATION = re.compile(r"(\d+)([mhd])")
+_UNITS = {"m": "minutes", "h": "hours", "d": "days"}
+
+
+def _since(value: str) -> str:
+    """'7d' / '12h' / '30m' ago, or a date like 2024-06-01 (UTC), as an ISO timestamp."""
+    m = _DURATION.fullmatch(value)
+    if m:
+        when = datetime.now(timezone.utc) - timedelta(**{_UNITS[m.group(2)]: int(m.group(1))})
+    else:
+        try:
+            when = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"'{value}' is neither a date (2024-06-01) nor a duration (7d, 12h, 30m)") from None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+    return when.isoformat()
+
+
+def _seconds(value: str) -> float:
+    m = _DURATION.fullmatch(value)
+    if not m:
+        raise ValueError(f"'{value}' isn't a duration (30m, 2h, 1d)")
+    return timedelta(**{_UNITS[m.group(2)]: int(m.group(1))}).total_seconds()
+
+
+def next_off_peak(now: datetime | None = None) -> tuple[datetime, float]:
+    """Start of the next BROADCAST_OFF_PEAK window ('HH:MM-HH:MM', UTC) and its length in seconds."""
+    now = now or datetime.now(timezone.utc)
+    start_s, end_s = BROADCAST_OFF_PEAK.split("-")
+    start, end = (datetime.strptime(t.strip(), "%H:%M").time() for t in (start_s, end_s))
+    today = datetime.combine(now.date(), start, timezone.utc)
+    length = timedelta(seconds=(datetime.combine(now.date(), end, timezone.utc) - today).total_seconds() % 86400)
+    # yesterday's window may still be open if it crosses midnight
+    begin = next(b for b in (today - timedelta(days=1), today, today + timedelta(days=1)) if b + length > now)
+    start_at = max(begin, now)
+    return start_at, (begin + length - start_at).total_seconds()
+
+
+def _send_time(value: str) -> tuple[datetime, float | None]:
+    """
+    at= values: 'offpeak', a delay (30m, 2h), a time of day (18:30, the next
+    one) or a date-time (2024-06-01T18:30), all UTC. Returns (when, the
+    window to spread over if the value implies one).
+    """
+    now = datetime.now(timezone.utc)
+    if value.lower() == "offpeak":
+        return next_off_peak(now)
+    if _DURATION.fullmatch(value):
+        return now + timedelta(seconds=_seconds(value)), None
+    try:
+        if re.fullmatch(r"\d{1,2}:\d{2}", value):
+            when = datetime.combine(now.date(), datetime.strptime(value, "%H:%M").time(), timezone.utc)
+            return (when if when > now else when + timedelta(days=1)), None
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"at= takes offpeak, a delay (2h), a time (18:30) or a date-time, not '{value}'") from None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    if when <= now:
+        raise ValueError(f"{value} is in the past")
+    return when, None
+
+
+def parse_broadcast_args(text: str) -> tuple[dict, int, dict, str]:
+    """
+    Splits leading options off a /broadcast text. Audience filters:
+        joined_after=2024-06-01|7d  active=7d  verified=yes|no
+    messages=N, to copy N consecutive messages starting at the replied one,
+    and scheduling: at=offpeak|2h|18:30|2024-06-01T18:30 (UTC) to send later,
+    spread=2h to pace delivery over that long (at=offpeak spreads over the
+    window unless spread= says otherwise).
+    Relative times are resolved now, so a resumed job keeps its audience.
+    Returns (audience, messages, schedule, rest of the text), schedule being
+    {"at": datetime | None, "spread": seconds | None}; raises ValueError on a bad value.
+    """
+    audience, messages = {}, 1
+    schedule = {"at": None, "spread": None}
+    window = None
+    while m := _OPTION.match(text):
+        key, value = m.groups()
+        if key == "joined_after":
+            audience["joined_after"] = _since(value)
+        elif key == "active":
+            audience["seen_after"] = _since(value)
+        elif key == "messages":
+            if not value.isdigit() or not 1 <= int(value) <= MAX_COPIED_MESSAGES:
+                raise ValueError(f"messages= takes 1 to {MAX_COPIED_MESSAGES}")
+            messages = int(value)
+        elif key == "at":
+            schedule["at"], window = _send_time(value)
+        elif key == "spread":
+            schedule["spread"] = _seconds(value)
+        elif value.lower() in ("yes", "no"):
+            audience["verified"] = value.lower() == "yes"
+        else:
+            raise ValueError("verified= takes yes or no")
+        text = text[m.end():]
+    if schedule["spread"] is None:
+        schedule["spread"] = window
+    return audience, messages, schedule, text.strip()
+
+
+def describe_schedule(job: dict) -> str:
+    parts = []
+    if job.get("scheduled_at"):
+        parts.append(f"at {job['scheduled_at']:%Y-%m-%d %H:%M} UTC")
+    if job.get("max_rate"):
+        parts.append(f"paced at {job['max_rate']:.2f} msg/s")
+    return ", ".join(parts)
+
+
+def describe_audience(audience: dict) -> str:
+    parts = []
+    if audience.get("joined_after"):
+        parts.append(f"joined after {audience['joined_after'][:16].replace('T', ' ')}")
+    if audience.get("seen_after"):
+        parts.append(f"active since {audience['seen_after'][:16].replace('T', ' ')}")
+    if "verified" in audience:
+        parts.append("verified" if audience["verified"] else "not verified")
+    return ", ".join(parts) or "all users"
+
+
+async def send_payload(bot: Bot, uid: int, payload: dict):
+    """One API call per user whatever the payload. Jobs from before parse_mode existed send plain text."""
+    kind = payload["kind"]
+    caption = payload.get("text") or None
+    parse_mode = payload.get("parse_mode")
+    if kind == "copy":
+        ids = payload["message_ids"]
+        if len(ids) == 1:
+            return await bot.copy_message(uid, payload["from_chat_id"], ids[0], rate_limit_args=BULK)
+        return await bot.copy_messages(uid, payload["from_chat_id"], ids, rate_limit_args=BULK)
+    if kind == "photo":
+        return await bot.send_photo(
+            uid, payload["file_id"], caption=caption, parse_mode=parse_mode, rate_limit_args=BULK
+        )
+    if kind == "video":
+        return await bot.send_video(
+            uid, payload["file_id"], caption=caption, parse_mode=parse_mode, rate_limit_args=BULK
+        )
+    if kind == "document":
+        return await bot.send_document(
+            uid, payload["file_id"], caption=caption, parse_mode=parse_mode, rate_limit_args=BULK
+        )
+    return await bot.send_message(uid, payload["text"], parse_mode=parse_mode, rate_limit_args=BULK)
+
+
+def processed(job: dict) -> int:
+    return job["sent"] + job["failed"] + job["skipped"]
+
+
+def _progress_text(job: dict, meter: ProgressMeter | None = None) -> str:
+    done = processed(job)
+    pct = done / job["total"] if job["total"] else 1.0
+    text = (
+        f"📣 Broadcast #{job['id']} — {job['status']}\n"
+        f"{done}/{job['total']} ({pct:.0%}) | ✅ {job['sent']} | ❌ {job['failed']} | 🚫 {job['skipped']}"
+    )
+    if meter and job["status"] == "running":
+        text += f"\n⚡ {meter.rate:.1f} msg/s | ETA {meter.eta(job['total'] - done)}"
+    return text
+
+
+async def run_shard(bot: Bot, shard: dict) -> None:
+    """Sends one leased shard of a job, batch by batch in user_id order."""
+    job_id, shard_no = shard["job_id"], shard["shard_no"]
+    payload = shard["payload"]
+    cursor = shard["last_user_id"]
+    # the shards of a job share BROADCAST_RATE (or the job's slower pace) between them
+    rate = min(BROADCAST_RATE, shard["max_rate"] or BROADCAST_RATE) / max(1, shard["shards"])
+    bucket = TokenBucket(rate)
+    # saving progress renews the lease, so a slow (paced) shard commits smaller
+    # batches: each must finish well within the lease or another replica takes over
+    batch_size = min(BROADCAST_BATCH_SIZE, max(1, int(rate * BROADCAST_SHARD_LEASE / 2)))
+    run = BroadcastResult()
+    logger.info(f"Broadcast #{job_id}/{shard_no} running from user_id > {cursor}")
+    status_msg = None
+    meter = ProgressMeter()
+    if shard["chat_id"] and shard["status_message_id"]:
+        # edited with progress, rate and ETA, at most every BROADCAST_STATUS_INTERVAL seconds
+        status_msg = StatusMessage(bot, shard["chat_id"], shard["status_message_id"], BROADCAST_STATUS_INTERVAL)
+
+    async def send(uid: int):
+        return await send_payload(bot, uid, payload)
+
+    # Streamed page by page, so memory stays flat however big `users` gets
+    pages = iter_user_id_pages(
+        after=cursor, page_size=batch_size, until=shard["to_user_id"], audience=shard["audience"]
+    )
+    async for batch in pages:
+        result = await run_broadcast(batch, send, bucket=bucket)
+        run.sent += result.sent
+        run.failed += result.failed
+        run.skipped += result.skipped
+        cursor = batch[-1]
+        # One statement per batch: progress, per-user receipts, unreachable users (skipped
+        # by every later broadcast until they /start again) and the lease's heartbeat.
+        # A crash re-sends at most this batch; a dead replica's shard is taken over
+        # once its lease expires.
+        job = await save_broadcast_progress(
+            job_id, shard_no, REPLICA_ID, cursor, result.sent, result.failed, result.unreachable, result.receipts
+        )
+        if job is None:
+            logger.warning(f"Broadcast #{job_id}/{shard_no}: lease lost to another replica")
+            return
+        meter.observe(processed(job))
+        if status_msg:
+            await status_msg.update(_progress_text(job, meter))
+        # pause/cancel are picked up here, at a batch boundary
+        if job["status"] != "running":
+            logger.info(f"Broadcast #{job_id}/{shard_no} stopped: {job['status']}")
+            await release_broadcast_shards(REPLICA_ID, job_id, shard_no)
+            if status_msg:
+                await status_msg.update(_progress_text(job), force=True)
+            return
+
+    run.finished = time.monotonic()
+    logger.info(f"Broadcast #{job_id}/{shard_no} done in {run.elapsed:.1f}s: {run.summary()}")
+    job = await finish_broadcast_shard(job_id, shard_no, REPLICA_ID)
+    if not job:
+        return  # other shards still running
+    if status_msg:
+        await status_msg.update(_progress_text(job), force=True)
+    if job["chat_id"]:
+        # from when it started sending, not from when it was created (or scheduled)
+        elapsed = (job["updated_at"] - (job["started_at"] or job["created_at"])).total_seconds()
+        rate = processed(job) / elapsed if elapsed > 0 else 0.0
+        await bot.send_message(
+            job["chat_id"],
+            f"Broadcast #{job_id} done. ✅ Sent: {job['sent']} | ❌ Failed: {job['failed']} "
+            f"| 🚫 Skipped: {job['skipped']} | ⚡ {rate:.1f} msg/s",
+        )
+
+
+class BroadcastDispatcher:
+    """
+    Runs on every replica: leases unfinished shards of running jobs and sends
+    them in the background. wake() makes it look right away (after a job is
+    created or resumed here); otherwise it polls every few seconds, which is
+    also how shards of crashed replicas get picked up.
+    """
+
+    def __init__(self, poll_interval: float = 5.0):
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def _run(self, bot: Bot) -> None:
+        released = False
+        while True:
+            try:
+                if not released:
+                    # leases our previous incarnation held can be taken back right away
+                    await release_broadcast_shards(REPLICA_ID)
+                    released = True
+                # one shard per tick so other replicas get a share
+                shard = await claim_broadcast_shard(REPLICA_ID, BROADCAST_SHARD_LEASE)
+                if shard:
+                    task_runner.spawn(("broadcast", shard["job_id"], shard["shard_no"]), run_shard(bot, shard))
+            except Exception as e:
+                logger.warning(f"Broadcast dispatcher failed to release or claim shards: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self, bot: Bot) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+dispatcher = BroadcastDispatcher()
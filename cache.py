@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from telegram import InlineKeyboardMarkup, InputMediaPhoto
+
+from config import (
+    MEMBER_CACHE_SIZE,
+    PER_USER_STATE_MAX,
+    FREE_STUFF_PAGE_SIZE,
+    FREE_STUFF_ARCHIVE_CHAT_ID,
+    FREE_STUFF_ARCHIVE_PAGE_SIZE,
+)
+from db import (
+    connection,
+    list_channels,
+    get_admin_ids,
+    list_free_images,
+    list_archived_free_images,
+    list_unarchived_free_images,
+)
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a per-entry TTL.
+    Not thread-safe; meant to be used from the bot's event loop.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SettingsCache:
+    """
+    Required channels (plus the verify keyboard built from them) and the admin
+    set, loaded from Postgres once and kept until invalidated. Invalidation
+    happens locally when an admin command changes them and, for other
+    replicas, through the LISTEN/NOTIFY listener in db.py.
+    """
+
+    def __init__(self, build_verify_markup: Callable[[list[str]], InlineKeyboardMarkup]):
+        self._build_verify_markup = build_verify_markup
+        self._channels: tuple[list[str], InlineKeyboardMarkup] | None = None
+        self._admins: frozenset[int] | None = None
+        self._channels_version = 0
+        self._admins_version = 0
+        self._lock = asyncio.Lock()
+
+    async def _load_channels(self) -> tuple[list[str], InlineKeyboardMarkup]:
+        async with self._lock:
+            if self._channels is None:
+                version = self._channels_version
+                channels = await list_channels()
+                entry = (channels, self._build_verify_markup(channels))
+                if version != self._channels_version:
+                    # invalidated while loading; serve it but don't keep it
+                    return entry
+                self._channels = entry
+            return self._channels
+
+    async def channels(self) -> list[str]:
+        entry = self._channels or await self._load_channels()
+        return entry[0]
+
+    async def verify_markup(self) -> InlineKeyboardMarkup:
+        entry = self._channels or await self._load_channels()
+        return entry[1]
+
+    async def admins(self) -> frozenset[int]:
+        if self._admins is not None:
+            return self._admins
+        async with self._lock:
+            if self._admins is None:
+                version = self._admins_version
+                admins = frozenset(await get_admin_ids())
+                if version != self._admins_version:
+                    return admins
+                self._admins = admins
+            return self._admins
+
+    async def is_admin(self, user_id: int) -> bool:
+        return user_id in await self.admins()
+
+    def invalidate(self, what: str = "all") -> None:
+        if what in ("channels", "all"):
+            self._channels = None
+            self._channels_version += 1
+        if what in ("admins", "all"):
+            self._admins = None
+            self._admins_version += 1
+        logger.debug(f"Settings cache invalidated: {what}")
+
+
+def _chunk(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class FreeStuffCache:
+    """
+    The Free Stuff pool pre-chunked into media-group pages, or with an
+    archive channel, into pages of its message ids for copy_messages. Images
+    that aren't in the archive yet (added before it existed, until
+    /syncarchive posts them) follow as media-group pages.
+    Rebuilt only after /add (locally or, via NOTIFY, on another replica).
+    """
+
+    def __init__(self, archive_chat_id: int | None = FREE_STUFF_ARCHIVE_CHAT_ID):
+        self.archive_chat_id = archive_chat_id
+        self._pages: list[list[InputMediaPhoto] | list[int]] | None = None
+        self._version = 0
+        self._lock = asyncio.Lock()
+
+    async def pages(self) -> list[list[InputMediaPhoto] | list[int]]:
+        if self._pages is not None:
+            return self._pages
+        async with self._lock:
+            if self._pages is None:
+                version = self._version
+                if self.archive_chat_id:
+                    async with connection():
+                        archived = await list_archived_free_images(self.archive_chat_id)
+                        file_ids = [f for _, f in await list_unarchived_free_images(self.archive_chat_id)]
+                    pages = _chunk(archived, FREE_STUFF_ARCHIVE_PAGE_SIZE)
+                else:
+                    file_ids = await list_free_images()
+                    pages = []
+                pages += _chunk([InputMediaPhoto(media=f) for f in file_ids], FREE_STUFF_PAGE_SIZE)
+                if version != self._version:
+                    return pages
+                self._pages = pages
+            return self._pages
+
+    def invalidate(self, what: str = "all") -> None:
+        if what in ("free_stuff", "all"):
+            self._pages = None
+            self._version += 1
+
+
+# (user_id, channel) -> is member
+member_cache = TTLCache(MEMBER_CACHE_SIZE)
+free_stuff_cache = FreeStuffCache()
+# (user_id, page) -> True while that page shouldn't be resent to the user
+free_stuff_cooldown = TTLCache(PER_USER_STATE_MAX)
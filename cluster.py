@@ -0,0 +1,239 @@
+"""
+Multi-replica mode (CLUSTER_MODE=true).
+
+Every replica consumes updates from the `update_queue` table and feeds them
+through the normal Application handlers. Getting updates *into* the queue:
+- polling: only the replica holding a Postgres advisory lock (the leader)
+  polls Telegram. Followers keep trying the lock, so if the leader dies its
+  session ends, the lock is freed and another replica takes over.
+- webhook: Railway's load balancer may hand Telegram's requests to any
+  replica, so every replica runs the webhook listener and enqueues.
+Broadcasts are split across replicas separately, see BroadcastDispatcher.
+"""
+import asyncio
+import json
+import logging
+import signal
+
+import asyncpg
+from telegram import Update
+from telegram.ext import Application, Updater
+
+from config import (
+    BOT_MODE,
+    PORT,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+    MAX_CONCURRENT_UPDATES,
+    ALLOWED_UPDATES,
+    LEADER_CHECK_INTERVAL,
+    UPDATE_CLAIM_TIMEOUT,
+    REPLICA_ID,
+)
+from db import (
+    DATABASE_URL,
+    UPDATE_QUEUE_CHANNEL,
+    listen,
+    connection,
+    enqueue_updates,
+    claim_updates,
+    ack_updates,
+)
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key held by the ingesting leader
+LEADER_LOCK_KEY = 0x7E1E6A4  # arbitrary, just unique to this bot
+
+
+def _user_key(update: Update) -> int | None:
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+def _queue_row(update: Update) -> tuple[int, int | None, str]:
+    return update.update_id, _user_key(update), json.dumps(update.to_dict())
+
+
+class ClusterNode:
+    def __init__(self, app: Application):
+        self.app = app
+        self.is_leader = False
+        self._ingest_queue: asyncio.Queue = asyncio.Queue()
+        self._updater: Updater | None = None
+        self._wakeup = asyncio.Event()
+        self._acks: list[int] = []
+        self._in_flight = 0
+        self._processing: set[asyncio.Task] = set()
+        self._tasks: list[asyncio.Task] = []
+
+    # ---------- Ingestion ----------
+    async def _start_ingest(self) -> None:
+        self._updater = Updater(bot=self.app.bot, update_queue=self._ingest_queue)
+        await self._updater.initialize()
+        if BOT_MODE == "webhook":
+            await self._updater.start_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        else:
+            await self._updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+
+    async def _stop_ingest(self) -> None:
+        if self._updater:
+            if self._updater.running:
+                await self._updater.stop()
+            await self._updater.shutdown()
+            self._updater = None
+
+    async def _forward(self) -> None:
+        """Moves ingested updates into Postgres, in batches."""
+        while True:
+            updates = [await self._ingest_queue.get()]
+            while not self._ingest_queue.empty() and len(updates) < 100:
+                updates.append(self._ingest_queue.get_nowait())
+            rows = [_queue_row(u) for u in updates if isinstance(u, Update)]
+            while True:
+                try:
+                    await enqueue_updates(rows)
+                    break
+                except Exception as e:
+                    logger.warning(f"Enqueueing {len(rows)} updates failed, retrying: {e}")
+                    await asyncio.sleep(1)
+
+    async def _lead(self) -> None:
+        """Polling mode: compete for the advisory lock; ingest while holding it."""
+        while True:
+            con = None
+            try:
+                con = await asyncpg.connect(DATABASE_URL)
+                while not await con.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_KEY):
+                    await asyncio.sleep(LEADER_CHECK_INTERVAL)
+                logger.info(f"Replica {REPLICA_ID} is now the leader")
+                self.is_leader = True
+                await self._start_ingest()
+                # the lock lives as long as this session; make sure it still does
+                while True:
+                    await asyncio.sleep(LEADER_CHECK_INTERVAL)
+                    await con.fetchval("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Leader session lost on {REPLICA_ID}: {e}")
+            finally:
+                if self.is_leader:
+                    self.is_leader = False
+                    await self._stop_ingest()
+                if con is not None and not con.is_closed():
+                    con.terminate()
+            await asyncio.sleep(LEADER_CHECK_INTERVAL)
+
+    # ---------- Consumption ----------
+    async def _process(self, queue_id: int, data: dict) -> None:
+        try:
+            update = Update.de_json(data, self.app.bot)
+            # same path Application uses: concurrency limit + per-user ordering
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+        except Exception:
+            logger.exception(f"Processing queued update {queue_id} failed")
+        finally:
+            self._in_flight -= 1
+            self._acks.append(queue_id)
+            self._wakeup.set()
+
+    async def _consume(self) -> None:
+        while True:
+            try:
+                acks, self._acks = self._acks, []
+                free = MAX_CONCURRENT_UPDATES - self._in_flight
+                # two statements: a claim must see the acks committed to release later updates
+                async with connection():
+                    await ack_updates(acks)
+                    claimed = await claim_updates(REPLICA_ID, free, UPDATE_CLAIM_TIMEOUT) if free > 0 else []
+            except Exception as e:
+                logger.warning(f"Update queue unavailable: {e}")
+                self._acks = acks + self._acks
+                claimed = []
+                await asyncio.sleep(1)
+            for queue_id, data in claimed:
+                self._in_flight += 1
+                task = asyncio.create_task(self._process(queue_id, data))
+                self._processing.add(task)
+                task.add_done_callback(self._processing.discard)
+            if claimed and len(claimed) == free:
+                continue  # probably more waiting
+            try:
+                # NOTIFY from the leader wakes us; poll anyway in case one is missed
+                await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    # ---------- Lifecycle ----------
+    async def start(self) -> None:
+        self._tasks.append(asyncio.create_task(self._forward()))
+        self._tasks.append(asyncio.create_task(listen(UPDATE_QUEUE_CHANNEL, lambda _: self._wakeup.set())))
+        self._tasks.append(asyncio.create_task(self._consume()))
+        if BOT_MODE == "webhook":
+            await self._start_ingest()
+        else:
+            self._tasks.append(asyncio.create_task(self._lead()))
+
+    async def stop(self) -> None:
+        # stop taking updates first, and hand the ones already fetched to the queue
+        await self._stop_ingest()
+        leftovers = []
+        while not self._ingest_queue.empty():
+            u = self._ingest_queue.get_nowait()
+            if isinstance(u, Update):
+                leftovers.append(_queue_row(u))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        try:
+            await enqueue_updates(leftovers)
+        except Exception as e:
+            logger.warning(f"Dropping {len(leftovers)} fetched updates: {e}")
+        # let in-flight updates finish; whatever doesn't is retried elsewhere
+        if self._processing:
+            await asyncio.wait(self._processing, timeout=10)
+        try:
+            await ack_updates(self._acks)
+        except Exception as e:
+            logger.warning(f"Final ack failed: {e}")
+
+
+async def run_cluster(app: Application) -> None:
+    """Replacement for run_polling/run_webhook in multi-replica mode."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    node = ClusterNode(app)
+    await node.start()
+    logger.info(f"Replica {REPLICA_ID} joined the cluster ({BOT_MODE} ingestion)")
+    try:
+        await stop.wait()
+    finally:
+        await node.stop()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
@@ -1,4 +1,5 @@
 import os
+import socket
 
 def _list_from_env(name: str) -> list[str]:
     raw = os.getenv(name, "").strip()
@@ -17,6 +18,8 @@ def _list_ints_from_env(name: str) -> list[int]:
     return out
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+# A self-hosted Bot API server (or benchmark.py's fake one) instead of Telegram's
+BOT_API_URL = (os.getenv("BOT_API_URL") or "https://api.telegram.org").rstrip("/")
 
 # Owner
 OWNER_ID = int(os.getenv("OWNER_ID", "0")) or None
@@ -35,3 +38,92 @@ SECONDARY_ADMINS = _list_ints_from_env("SECONDARY_ADMINS")
 
 # Promo toggle
 START_SOCIAL_PROMO = os.getenv("START_SOCIAL_PROMO", "true").lower() in ("1", "true", "yes")
+
+# Broadcast pacing (Telegram allows roughly 30 msgs/s globally)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # msgs per second
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))  # parallel senders
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))  # progress is committed per batch
+BROADCAST_STATUS_INTERVAL = float(os.getenv("BROADCAST_STATUS_INTERVAL", "5"))  # min seconds between status edits
+# /broadcast at=offpeak sends in the next one of these daily windows (UTC), spread over it
+BROADCAST_OFF_PEAK = os.getenv("BROADCAST_OFF_PEAK", "02:00-06:00")
+# how often every replica reloads scheduled broadcasts from Postgres into its JobQueue
+SCHEDULED_BROADCAST_SYNC_INTERVAL = float(os.getenv("SCHEDULED_BROADCAST_SYNC_INTERVAL", "60"))
+
+# Outbound scheduler for every Bot API call that posts to a chat (per replica):
+# messages per second overall, per private chat and per group/channel, plus the
+# burst a single chat may use, and how often a call is retried after a 429
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_PRIVATE_CHAT_RATE = float(os.getenv("OUTBOUND_PRIVATE_CHAT_RATE", "1"))
+OUTBOUND_GROUP_CHAT_RATE = float(os.getenv("OUTBOUND_GROUP_CHAT_RATE", str(20 / 60)))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Channel-membership cache (seconds). Keep the negative TTL short so users
+# who just joined can verify again quickly.
+MEMBER_CACHE_POSITIVE_TTL = float(os.getenv("MEMBER_CACHE_POSITIVE_TTL", "600"))
+MEMBER_CACHE_NEGATIVE_TTL = float(os.getenv("MEMBER_CACHE_NEGATIVE_TTL", "10"))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "50000"))
+# Entries kept per user/chat by the other bounded in-memory tables: flood
+# buckets, per-chat send limits, Free Stuff cooldowns, last_seen throttling
+PER_USER_STATE_MAX = int(os.getenv("PER_USER_STATE_MAX", "50000"))
+# Users verified within this window skip the membership checks entirely
+VERIFIED_TTL = int(os.getenv("VERIFIED_TTL", "3600"))
+
+# Write-behind buffer for /start user upserts
+USER_FLUSH_INTERVAL_MS = int(os.getenv("USER_FLUSH_INTERVAL_MS", "200"))
+USER_FLUSH_MAX_ROWS = int(os.getenv("USER_FLUSH_MAX_ROWS", "500"))
+# users.last_seen is written at most once per user per this many seconds
+LAST_SEEN_RESOLUTION = int(os.getenv("LAST_SEEN_RESOLUTION", "900"))
+# /stats counters are summed in memory and added to daily_stats this often (seconds)
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "10"))
+
+# Free Stuff delivery
+FREE_STUFF_PAGE_SIZE = min(10, int(os.getenv("FREE_STUFF_PAGE_SIZE", "10")))  # media group max is 10
+FREE_STUFF_COOLDOWN = float(os.getenv("FREE_STUFF_COOLDOWN", "60"))  # seconds before a page is resent
+# Optional private "storage" channel the bot posts Free Stuff to (the bot must be an
+# admin there); pages are then copied from it with copy_messages, up to 100 per call
+FREE_STUFF_ARCHIVE_CHAT_ID = int(os.getenv("FREE_STUFF_ARCHIVE_CHAT_ID") or 0) or None
+FREE_STUFF_ARCHIVE_PAGE_SIZE = min(100, int(os.getenv("FREE_STUFF_ARCHIVE_PAGE_SIZE", "100")))  # copy_messages max
+
+# Update delivery: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+PORT = int(os.getenv("PORT", "8443"))  # Railway injects PORT for web services
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # public base URL, e.g. https://myapp.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or None  # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Updates handled at once (updates from the same user still run in order)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+# chat_member isn't delivered unless asked for; it feeds the channel_members mirror
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+# Multi-replica mode: a Postgres advisory-lock leader ingests updates into a
+# queue table that every replica consumes; broadcasts are split into shards.
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "false").lower() in ("1", "true", "yes")
+REPLICA_ID = (
+    (os.getenv("RAILWAY_REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}") if CLUSTER_MODE
+    else "main"  # stable, so a restarted single worker can take back its own shard leases at once
+)
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "5"))  # seconds
+UPDATE_CLAIM_TIMEOUT = float(os.getenv("UPDATE_CLAIM_TIMEOUT", "60"))  # seconds before a claimed update is retried
+# user_id ranges per broadcast; the total BROADCAST_RATE is shared between them
+BROADCAST_SHARDS = int(os.getenv("BROADCAST_SHARDS", "4" if CLUSTER_MODE else "1"))
+BROADCAST_SHARD_LEASE = float(os.getenv("BROADCAST_SHARD_LEASE", "120"))  # seconds without progress before takeover
+
+# Per-user flood control: tokens per second and burst size for each action
+FLOOD_VERIFY_RATE = float(os.getenv("FLOOD_VERIFY_RATE", "0.2"))
+FLOOD_VERIFY_BURST = float(os.getenv("FLOOD_VERIFY_BURST", "3"))
+FLOOD_FREE_STUFF_RATE = float(os.getenv("FLOOD_FREE_STUFF_RATE", "0.2"))
+FLOOD_FREE_STUFF_BURST = float(os.getenv("FLOOD_FREE_STUFF_BURST", "3"))
+FLOOD_COMMANDS_RATE = float(os.getenv("FLOOD_COMMANDS_RATE", "1"))
+FLOOD_COMMANDS_BURST = float(os.getenv("FLOOD_COMMANDS_BURST", "5"))
+
+# asyncpg pool. Set DB_STATEMENT_CACHE_SIZE=0 behind PgBouncer in transaction mode.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+# Prometheus metrics served at :METRICS_PORT/metrics (0 disables)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
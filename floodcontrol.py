@@ -0,0 +1,66 @@
+import time
+
+from telegram import Update
+
+from cache import TTLCache
+from config import (
+    FLOOD_VERIFY_RATE,
+    FLOOD_VERIFY_BURST,
+    FLOOD_FREE_STUFF_RATE,
+    FLOOD_FREE_STUFF_BURST,
+    FLOOD_COMMANDS_RATE,
+    FLOOD_COMMANDS_BURST,
+    PER_USER_STATE_MAX,
+)
+
+
+def classify(update: Update) -> str:
+    """Which budget an update draws from: 'verify', 'free_stuff' or 'commands'."""
+    if update.callback_query:
+        action = (update.callback_query.data or "").partition(":")[0]
+        if action in ("verify", "free_stuff"):
+            return action
+    return "commands"
+
+
+class UserRateLimiter:
+    """
+    Non-blocking token buckets per (user, action). A bucket that has been idle
+    long enough to refill completely is simply evicted, so memory only holds
+    users who were active recently.
+    """
+
+    def __init__(self, budgets: dict[str, tuple[float, float]], maxsize: int = PER_USER_STATE_MAX):
+        self.budgets = budgets  # action -> (tokens per second, burst)
+        self._buckets = TTLCache(maxsize)  # (user_id, action) -> (tokens, updated)
+        self.allowed = {action: 0 for action in budgets}
+        self.throttled = {action: 0 for action in budgets}  # callback queries answered cheaply
+        self.dropped = {action: 0 for action in budgets}  # messages ignored
+
+    def allow(self, user_id: int, action: str) -> bool:
+        rate, burst = self.budgets[action]
+        now = time.monotonic()
+        key = (user_id, action)
+        state = self._buckets.get(key)
+        tokens = burst if state is None else min(burst, state[0] + (now - state[1]) * rate)
+        ok = tokens >= 1
+        if ok:
+            tokens -= 1
+            self.allowed[action] += 1
+        self._buckets.set(key, (tokens, now), ttl=(burst - tokens) / rate)
+        return ok
+
+    def stats(self) -> dict:
+        return {
+            "allowed": dict(self.allowed),
+            "throttled": dict(self.throttled),
+            "dropped": dict(self.dropped),
+            "tracked": len(self._buckets),
+        }
+
+
+flood_limiter = UserRateLimiter({
+    "verify": (FLOOD_VERIFY_RATE, FLOOD_VERIFY_BURST),
+    "free_stuff": (FLOOD_FREE_STUFF_RATE, FLOOD_FREE_STUFF_BURST),
+    "commands": (FLOOD_COMMANDS_RATE, FLOOD_COMMANDS_BURST),
+})
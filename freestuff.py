@@ -0,0 +1,85 @@
+"""
+Keeps the free_stuff table and the Free Stuff archive channel
+(FREE_STUFF_ARCHIVE_CHAT_ID) in step; run by /syncarchive.
+"""
+
+import logging
+
+from telegram import Bot
+from telegram.error import BadRequest
+
+from db import (
+    list_archived_free_images,
+    list_unarchived_free_images,
+    set_free_image_archived,
+    import_archived_free_images,
+)
+from outbound import BACKGROUND
+from tasks import StatusMessage
+
+logger = logging.getLogger(__name__)
+
+# consecutive missing message ids after which the archive scan assumes it's at the end
+SCAN_GIVE_UP_AFTER = 50
+# delete_messages takes at most 100 ids
+DELETE_BATCH = 100
+
+
+async def sync_archive(
+    bot: Bot, archive_chat_id: int, scratch_chat_id: int, status: StatusMessage, last_message_id: int | None = None
+) -> tuple[int, int]:
+    """
+    Posts images the archive doesn't have yet, then re-imports photos from
+    the archive that the table doesn't know (e.g. after losing the DB).
+    The Bot API can't read a channel's history, so every unknown message
+    is forwarded to `scratch_chat_id` (which hands back its file_id) and
+    the forwards are deleted again in batches. The scan runs up to
+    `last_message_id`, or until SCAN_GIVE_UP_AFTER ids in a row are missing.
+    Returns (posted, imported).
+    """
+    posted = 0
+    for image_id, file_id in await list_unarchived_free_images(archive_chat_id):
+        msg = await bot.send_photo(archive_chat_id, file_id, disable_notification=True, rate_limit_args=BACKGROUND)
+        await set_free_image_archived(image_id, archive_chat_id, msg.message_id)
+        posted += 1
+        await status.update(f"🗄 Archive sync: posted {posted} image(s) to the archive…")
+
+    known = set(await list_archived_free_images(archive_chat_id))
+    end = last_message_id or max(known, default=0)
+    found: list[tuple[int, str]] = []
+    forwards: list[int] = []
+    message_id = misses = 0
+    try:
+        while message_id < end or (last_message_id is None and misses < SCAN_GIVE_UP_AFTER):
+            message_id += 1
+            if message_id in known:
+                misses = 0
+                continue
+            try:
+                msg = await bot.forward_message(
+                    scratch_chat_id, archive_chat_id, message_id, disable_notification=True,
+                    rate_limit_args=BACKGROUND,
+                )
+            except BadRequest:
+                misses += 1  # deleted, or past the end
+                continue
+            misses = 0
+            forwards.append(msg.message_id)
+            if msg.photo:
+                found.append((message_id, msg.photo[-1].file_id))
+            if len(forwards) >= DELETE_BATCH:
+                await bot.delete_messages(scratch_chat_id, forwards, rate_limit_args=BACKGROUND)
+                forwards = []
+            await status.update(
+                f"🗄 Archive sync: posted {posted}, scanned up to message {message_id}, "
+                f"{len(found)} photo(s) to import…"
+            )
+    finally:
+        if forwards:
+            try:
+                await bot.delete_messages(scratch_chat_id, forwards, rate_limit_args=BACKGROUND)
+            except Exception as e:
+                logger.warning(f"Couldn't clean up {len(forwards)} forwarded archive messages: {e}")
+    imported = await import_archived_free_images(archive_chat_id, found)
+    logger.info(f"Archive sync: posted {posted}, imported {imported} (scanned {message_id} ids)")
+    return posted, imported
@@ -1,14 +1,14 @@
 import asyncio
 import logging
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
 from urllib.parse import quote
 
 from telegram import (
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    InputMediaPhoto,
 )
 from telegram.constants import ChatMemberStatus, ParseMode
 from telegram.ext import (
@@ -16,12 +16,16 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
 )
 
 from config import (
     BOT_TOKEN,
+    BOT_API_URL,
     OWNER_ID,
     OWNER_USERNAME,
     SOCIAL_YT,
@@ -30,24 +34,72 @@ from config import (
     MAIN_ADMIN_ID,
     SECONDARY_ADMINS,
     START_SOCIAL_PROMO,
+    MEMBER_CACHE_POSITIVE_TTL,
+    MEMBER_CACHE_NEGATIVE_TTL,
+    VERIFIED_TTL,
+    FREE_STUFF_COOLDOWN,
+    FREE_STUFF_ARCHIVE_CHAT_ID,
+    BOT_MODE,
+    PORT,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+    MAX_CONCURRENT_UPDATES,
+    ALLOWED_UPDATES,
+    CLUSTER_MODE,
+    REPLICA_ID,
+    BROADCAST_SHARDS,
+    SCHEDULED_BROADCAST_SYNC_INTERVAL,
+    METRICS_PORT,
 )
 from db import (
     init_db,
     pool,
     ensure_bootstrap_data,
-    upsert_user,
-    get_admin_ids,
-    is_admin,
+    mark_verified,
     add_free_image,
-    list_free_images,
-    list_channels,
+    listen_settings_changes,
     upsert_channel,
     delete_channel,
+    list_unresolved_channels,
+    set_channel_chat_id,
+    get_verification_state,
+    get_daily_stats,
     list_admins,
     add_admin,
     remove_admin,
-    all_user_ids,
+    count_users,
+    create_broadcast_job,
+    start_broadcast_job,
+    list_scheduled_broadcasts,
+    start_scheduled_broadcast,
+    list_broadcast_jobs,
+    set_broadcast_status,
+    release_broadcast_shards,
+    record_media_group_message,
+    get_media_group_message_ids,
+    pool_stats,
+    connection,
+    start_round_trip_count,
 )
+from broadcast import broadcast_payload, parse_broadcast_args, describe_audience, describe_schedule, dispatcher
+from cache import member_cache, free_stuff_cache, free_stuff_cooldown, SettingsCache
+from writebehind import user_buffer, stats_buffer
+from metrics import (
+    registry,
+    Gauge,
+    InstrumentedRequest,
+    timed,
+    update_latency,
+    update_seconds,
+    db_round_trips,
+    start_metrics_server,
+)
+from tasks import PerUserUpdateProcessor, StatusMessage, task_runner
+from outbound import scheduler
+from freestuff import sync_archive
+from floodcontrol import classify, flood_limiter
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO
@@ -71,30 +123,74 @@ def channel_display_and_link(raw: str) -> tuple[str, str | None]:
 
 async def get_effective_required_channels(context: ContextTypes.DEFAULT_TYPE) -> list[str]:
     """
-    We store channels in DB for scalability; on first run we prefill from env.
+    We store channels in DB for scalability (env ones are added at startup).
+    Served from settings_cache, so the hot path doesn't touch the DB.
     """
-    db_channels = await list_channels()
-    if db_channels:
-        return db_channels
-    # seed from env on first boot
-    for ch in REQUIRED_CHANNELS:
-        await upsert_channel(ch)
-    return await list_channels()
+    return await settings_cache.channels()
+
+
+def is_member_status(member) -> bool:
+    if member.status == ChatMemberStatus.RESTRICTED:
+        return member.is_member
+    return member.status not in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED)
 
 
-async def is_member_of(context: ContextTypes.DEFAULT_TYPE, user_id: int, channel: str) -> bool:
+async def is_member_of(context: ContextTypes.DEFAULT_TYPE, user_id: int, channel: str,
+                       resolved_id: int | None = None) -> bool:
     """
     channel may be '@name' or numeric id. Use get_chat_member to check.
+    Answers are cached per (user, channel) with separate positive/negative TTLs,
+    and mirrored into channel_members when the channel's id is known.
     """
+    cached = member_cache.get((user_id, channel))
+    if cached is not None:
+        return cached
     chat_id = channel if channel.startswith("@") else int(channel)
     try:
         member = await context.bot.get_chat_member(chat_id, user_id)
-        status = member.status
-        return status not in (ChatMemberStatus.LEFT, ChatMemberStatus.KICKED)
+        ok = is_member_status(member)
     except Exception as e:
         logger.warning(f"Membership check failed for user {user_id} in {channel}: {e}")
-        # If we can’t check (e.g., bot lacks rights), treat as not a member
+        # If we can’t check (e.g., bot lacks rights), treat as not a member (uncached)
         return False
+    ttl = MEMBER_CACHE_POSITIVE_TTL if ok else MEMBER_CACHE_NEGATIVE_TTL
+    member_cache.set((user_id, channel), ok, ttl)
+    if resolved_id is not None:
+        user_buffer.set_membership(resolved_id, user_id, ok, datetime.now(timezone.utc))
+    return ok
+
+
+async def check_memberships(
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    channels: list[str],
+    known: dict[str, tuple[int | None, bool | None]],
+) -> list[bool]:
+    """
+    Membership in each channel. Members we've seen join (chat_member updates,
+    or an earlier check; `known`, from get_verification_state) need no API
+    call; only channels where the user isn't known to be a member cost a
+    get_chat_member call, since their join may still be on its way to us.
+    """
+
+    async def check(channel: str) -> bool:
+        resolved_id, is_member = known.get(channel, (None, None))
+        if is_member:
+            return True
+        return await is_member_of(context, user_id, channel, resolved_id)
+
+    return list(await asyncio.gather(*[check(ch) for ch in channels]))
+
+
+async def resolve_channel_ids(bot) -> None:
+    """Looks up the numeric id of '@name' channels, which chat_member updates are keyed by."""
+    for ident in await list_unresolved_channels():
+        try:
+            chat = await bot.get_chat(ident)
+        except Exception as e:
+            logger.warning(f"Couldn't resolve channel {ident}: {e}")
+            continue
+        await set_channel_chat_id(ident, chat.id)
 
 
 def owner_deeplink(text: str) -> str | None:
@@ -148,6 +244,10 @@ def verify_kb(required_channels: list[str]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+# Channels + their verify keyboard, and the admin set; rebuilt only on change
+settings_cache = SettingsCache(verify_kb)
+
+
 async def send_social_promo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not START_SOCIAL_PROMO:
         return
@@ -169,8 +269,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ---------- Handlers ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    await upsert_user(user.id, user.first_name or "", datetime.utcnow())
-    required_channels = await get_effective_required_channels(context)
+    # Buffered: written with other /start users in one multi-row upsert
+    user_buffer.add(user.id, user.first_name or "", datetime.utcnow())
 
     # Greeting
     first_name = user.first_name or "there"
@@ -181,22 +281,83 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Subscription panel
     await update.effective_chat.send_message(
         "Join all channels below, then tap ✅ Verify:",
-        reply_markup=verify_kb(required_channels),
+        reply_markup=await settings_cache.verify_markup(),
     )
 
 
+async def send_free_stuff_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Sends one cached page (album) of the Free Stuff pool, plus a "More ▶"
+    button carrying the next page number. A page already sent to this user
+    within FREE_STUFF_COOLDOWN is not sent again.
+    """
+    query = update.callback_query
+    raw = query.data.partition(":")[2]
+    page_no = int(raw) if raw.isdigit() else 0
+    key = (query.from_user.id, page_no)
+    if free_stuff_cooldown.get(key):
+        await query.answer("Already sent — scroll up 👆")
+        return
+    await query.answer()
+
+    pages = await free_stuff_cache.pages()
+    if not pages:
+        await query.message.reply_text("No free PFPs yet—check back soon!")
+        return
+    if page_no >= len(pages):
+        await query.message.reply_text("That's everything for now—check back soon!")
+        return
+
+    free_stuff_cooldown.set(key, True, FREE_STUFF_COOLDOWN)
+    page = pages[page_no]
+    try:
+        if isinstance(page[0], int):
+            # archived: the whole page (up to 100 images) in one call
+            await context.bot.copy_messages(update.effective_chat.id, free_stuff_cache.archive_chat_id, page)
+        elif len(page) == 1:
+            # media groups need at least 2 items
+            await context.bot.send_photo(update.effective_chat.id, page[0].media)
+        else:
+            await context.bot.send_media_group(chat_id=update.effective_chat.id, media=page)
+    except Exception as e:
+        logger.error(f"Failed to send free stuff page {page_no}: {e}")
+        free_stuff_cooldown.pop(key)
+        return
+
+    if page_no + 1 < len(pages):
+        await update.effective_chat.send_message(
+            f"Page {page_no + 1}/{len(pages)}",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("More ▶", callback_data=f"free_stuff:{page_no + 1}")]]
+            ),
+        )
+
+
 async def cbq_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
+
+    # Free Stuff answers the query itself (with a hint while on cooldown)
+    if (query.data or "").partition(":")[0] == "free_stuff":
+        stats_buffer.incr("free_stuff_taps")
+        await send_free_stuff_page(update, context)
+        return
+
     await query.answer()
 
     if query.data == "verify":
         user_id = query.from_user.id
+        # one query: recently verified users skip the membership checks entirely
+        recently_verified, known = await get_verification_state(user_id, VERIFIED_TTL)
+        if recently_verified:
+            stats_buffer.incr("verify_passed")
+            await show_main_menu(update, context)
+            return
         required_channels = await get_effective_required_channels(context)
         # Check membership
-        checks = await asyncio.gather(
-            *[is_member_of(context, user_id, ch) for ch in required_channels]
-        )
+        checks = await check_memberships(context, user_id, required_channels, known)
+        stats_buffer.incr("verify_passed" if all(checks) else "verify_failed")
         if all(checks):
+            await mark_verified(user_id)
             await query.message.reply_text("✅ Verified! Taking you to the Main Menu…")
             await show_main_menu(update, context)
             # Social promo
@@ -211,28 +372,6 @@ async def cbq_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 f"{missing_list}"
             )
 
-    elif query.data == "free_stuff":
-        images = await list_free_images()
-        if not images:
-            await query.message.reply_text("No free PFPs yet—check back soon!")
-            return
-
-        # Telegram allows media groups up to 10 items; our pool is images only
-        CHUNK = 10
-        batch = []
-        for i, file_id in enumerate(images, start=1):
-            batch.append(InputMediaPhoto(media=file_id))
-            if len(batch) == CHUNK or i == len(images):
-                # send this batch
-                try:
-                    await context.bot.send_media_group(
-                        chat_id=update.effective_chat.id,
-                        media=batch,
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send free stuff batch: {e}")
-                batch = []
-
     elif query.data == "noop":
         await query.message.reply_text("✅ We’ve opened the chat (or provided the link). Please check your Telegram.")
     else:
@@ -254,7 +393,7 @@ async def echo_confirmation_for_owner_buttons(update: Update, context: ContextTy
 # ---------- Admin commands ----------
 async def admin_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     uid = update.effective_user.id
-    if await is_admin(uid):
+    if await settings_cache.is_admin(uid):
         return True
     await update.effective_chat.send_message("⛔️ Admins only.")
     return False
@@ -276,10 +415,55 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # largest size photo has the best quality; we only need file_id
     file_id = reply.photo[-1].file_id
-    await add_free_image(file_id, update.effective_user.id)
+    archive_message_id = None
+    if FREE_STUFF_ARCHIVE_CHAT_ID:
+        try:
+            archived = await context.bot.send_photo(FREE_STUFF_ARCHIVE_CHAT_ID, file_id, disable_notification=True)
+        except Exception as e:
+            logger.error(f"Failed to post image to the Free Stuff archive: {e}")
+            await update.effective_chat.send_message("❌ Couldn't post the image to the archive channel.")
+            return
+        archive_message_id = archived.message_id
+    await add_free_image(file_id, update.effective_user.id, FREE_STUFF_ARCHIVE_CHAT_ID, archive_message_id)
+    free_stuff_cache.invalidate()
     await update.effective_chat.send_message("✅ Image added to Free Stuff pool.")
 
 
+async def cmd_syncarchive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /syncarchive [last_message_id]: posts images the archive channel lacks
+    and re-imports archived photos missing from the table, in the background.
+    """
+    if not await admin_guard(update, context):
+        return
+    if not FREE_STUFF_ARCHIVE_CHAT_ID:
+        await update.effective_chat.send_message("Set FREE_STUFF_ARCHIVE_CHAT_ID to use an archive channel.")
+        return
+    last_message_id = None
+    if context.args:
+        if not context.args[0].isdigit():
+            await update.effective_chat.send_message("Usage: /syncarchive [last_message_id]")
+            return
+        last_message_id = int(context.args[0])
+    if task_runner.is_running("syncarchive"):
+        await update.effective_chat.send_message("An archive sync is already running.")
+        return
+    chat_id = update.effective_chat.id
+    msg = await update.effective_chat.send_message("🗄 Archive sync starting…")
+    status = StatusMessage(context.bot, chat_id, msg.message_id)
+
+    async def run():
+        posted, imported = await sync_archive(
+            context.bot, FREE_STUFF_ARCHIVE_CHAT_ID, chat_id, status, last_message_id
+        )
+        free_stuff_cache.invalidate()
+        await status.update(
+            f"🗄 Archive sync done: posted {posted} image(s), imported {imported}.", force=True
+        )
+
+    task_runner.spawn("syncarchive", run())
+
+
 async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await admin_guard(update, context):
         return
@@ -287,45 +471,262 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not update.message:
         return
 
-    args_text = update.message.text.partition(" ")[2].strip() if update.message.text else ""
+    # HTML, so the text keeps its formatting
+    args_text = update.message.text_html.partition(" ")[2].strip() if update.message.text else ""
+    # optional leading filters, e.g. /broadcast joined_after=7d verified=yes at=offpeak Hello!
+    try:
+        audience, count, schedule, args_text = parse_broadcast_args(args_text)
+    except ValueError as e:
+        await update.effective_chat.send_message(f"Bad filter: {e}")
+        return
+    reply = update.message.reply_to_message
+    if not reply and not args_text:
+        await update.effective_chat.send_message(
+            "Usage: /broadcast [filters] <text>, or reply to a message with /broadcast [filters]."
+        )
+        return
+    if not reply and count > 1:
+        await update.effective_chat.send_message(
+            "messages=N copies N messages starting at the replied one; reply to the first of them."
+        )
+        return
+    if schedule["at"] and context.job_queue is None:
+        await update.effective_chat.send_message(
+            "Scheduling needs the job queue: install python-telegram-bot[job-queue]."
+        )
+        return
+
+    # A reply to an album item or with messages=N copies several messages in one call per user
+    message_ids = None
+    if reply and count > 1:
+        message_ids = list(range(reply.message_id, reply.message_id + count))
+    elif reply and reply.media_group_id:
+        message_ids = await get_media_group_message_ids(reply.chat_id, reply.media_group_id)
+    if message_ids and len(message_ids) > 1 and args_text:
+        await update.effective_chat.send_message(
+            "Albums and messages=N are copied as they are; put the caption on the post itself."
+        )
+        return
+
+    # Stored as a job so a redeploy resumes it instead of starting over
+    payload = broadcast_payload(reply, args_text, message_ids)
+    async with connection():
+        total = await count_users(audience=audience)
+        if total:
+            # spread= paces the job so it lasts about that long
+            max_rate = total / schedule["spread"] if schedule["spread"] else None
+            job_id = await create_broadcast_job(
+                update.effective_user.id, update.effective_chat.id, payload, total,
+                shards=BROADCAST_SHARDS, audience=audience, max_rate=max_rate,
+            )
+    if not total:
+        await update.effective_chat.send_message("No users match." if audience else "No users yet.")
+        return
+    if schedule["at"]:
+        job = {"scheduled_at": schedule["at"], "max_rate": max_rate}
+        status = await update.effective_chat.send_message(
+            f"🕒 Broadcast #{job_id} for {total} users ({describe_audience(audience)}) scheduled "
+            f"{describe_schedule(job)}. /cancelbroadcast {job_id} to drop it."
+        )
+        await start_broadcast_job(job_id, status.message_id, scheduled_at=schedule["at"])
+        schedule_broadcast(context.job_queue, job_id, schedule["at"])
+        return
+    # Runs off the update path (on any replica); this message is edited with its progress
+    status = await update.effective_chat.send_message(
+        f"📣 Broadcast #{job_id} started for {total} users ({describe_audience(audience)}). "
+        "Track it with /broadcasts."
+    )
+    await start_broadcast_job(job_id, status.message_id)
+    dispatcher.wake()
+
+
+def schedule_broadcast(job_queue, job_id: int, at: datetime) -> None:
+    """Registers a scheduled job's start with the JobQueue, once per replica."""
+    name = f"broadcast:{job_id}"
+    if not job_queue.get_jobs_by_name(name):
+        # a time that passed while we were down means now, not a missed run
+        when = max(at, datetime.now(timezone.utc) + timedelta(seconds=1))
+        job_queue.run_once(run_scheduled_broadcast, when=when, data=job_id, name=name)
+
+
+async def run_scheduled_broadcast(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # every replica fires; the first to flip the job to 'running' starts it, and the
+    # dispatchers of all of them then share its shards as usual
+    job_id = context.job.data
+    if await start_scheduled_broadcast(job_id):
+        logger.info(f"Scheduled broadcast #{job_id} started")
+        dispatcher.wake()
+
+
+async def load_scheduled_broadcasts(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Postgres is the source of truth for scheduled jobs: this picks up ones
+    created before a restart or on another replica.
+    """
+    try:
+        for job_id, at in await list_scheduled_broadcasts():
+            schedule_broadcast(context.job_queue, job_id, at)
+    except Exception as e:
+        logger.warning(f"Couldn't load scheduled broadcasts: {e}")
+
+
+async def remember_album_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Albums arrive one message per item; keep admins' ones so /broadcast can copy them whole."""
+    msg = update.message
+    if msg.media_group_id and await settings_cache.is_admin(update.effective_user.id):
+        await record_media_group_message(msg.chat_id, msg.media_group_id, msg.message_id)
+
 
-    user_ids = await all_user_ids()
-    if not user_ids:
-        await update.effective_chat.send_message("No users yet.")
+async def cmd_audience(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Dry run: how many users /broadcast with the same filters would reach."""
+    if not await admin_guard(update, context):
+        return
+    try:
+        audience, _, _, _ = parse_broadcast_args(" ".join(context.args))
+    except ValueError as e:
+        await update.effective_chat.send_message(f"Bad filter: {e}")
         return
+    total = await count_users(audience=audience)
+    await update.effective_chat.send_message(
+        f"👥 {total} users ({describe_audience(audience)}).\n"
+        "Filters: joined_after=2024-06-01|7d  active=7d  verified=yes|no"
+    )
 
-    sent = 0
-    failed = 0
 
-    async def send_to(uid: int):
-        nonlocal sent, failed
+async def cmd_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    jobs = await list_broadcast_jobs()
+    if not jobs:
+        await update.effective_chat.send_message("No broadcasts yet.")
+        return
+    lines = [
+        f"• #{j['id']} {j['status']} — {j['sent'] + j['failed'] + j['skipped']}/{j['total']} "
+        f"(✅ {j['sent']} | ❌ {j['failed']} | 🚫 {j['skipped']}) — {describe_audience(j['audience'])}"
+        + (f" — {when}" if (when := describe_schedule(j)) else "")
+        for j in jobs
+    ]
+    await update.effective_chat.send_message("Broadcasts:\n" + "\n".join(lines))
+
+
+async def _broadcast_job_arg(update: Update, context: ContextTypes.DEFAULT_TYPE, usage: str) -> int | None:
+    if not context.args:
+        await update.effective_chat.send_message(f"Usage: {usage} <job_id>")
+        return None
+    try:
+        return int(context.args[0].lstrip("#"))
+    except ValueError:
+        await update.effective_chat.send_message("Provide a numeric job ID.")
+        return None
+
+
+async def cmd_pausebroadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    job_id = await _broadcast_job_arg(update, context, "/pausebroadcast")
+    if job_id is None:
+        return
+    if await set_broadcast_status(job_id, "paused", ("pending", "running")):
+        await update.effective_chat.send_message(f"⏸ Broadcast #{job_id} paused.")
+    else:
+        await update.effective_chat.send_message(f"Broadcast #{job_id} isn't running.")
+
+
+async def cmd_resumebroadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    job_id = await _broadcast_job_arg(update, context, "/resumebroadcast")
+    if job_id is None:
+        return
+    if await set_broadcast_status(job_id, "running", ("paused",)):
+        dispatcher.wake()
+        await update.effective_chat.send_message(f"▶️ Broadcast #{job_id} resumed.")
+    else:
+        await update.effective_chat.send_message(f"Broadcast #{job_id} isn't paused.")
+
+
+async def cmd_cancelbroadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    job_id = await _broadcast_job_arg(update, context, "/cancelbroadcast")
+    if job_id is None:
+        return
+    if await set_broadcast_status(job_id, "cancelled", ("pending", "scheduled", "running", "paused")):
+        # other replicas' timers find the job cancelled and do nothing
+        for job in context.job_queue.get_jobs_by_name(f"broadcast:{job_id}") if context.job_queue else ():
+            job.schedule_removal()
+        await update.effective_chat.send_message(f"🛑 Broadcast #{job_id} cancelled.")
+    else:
+        await update.effective_chat.send_message(f"Broadcast #{job_id} can't be cancelled.")
+
+
+async def cmd_cachestats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    st = member_cache.stats()
+    wb = user_buffer.stats()
+    await update.effective_chat.send_message(
+        "Membership cache:\n"
+        f"• size: {st['size']}/{st['maxsize']}\n"
+        f"• hits: {st['hits']} | misses: {st['misses']} ({st['hit_rate']:.0%} hit rate)\n"
+        f"• evictions: {st['evictions']}\n"
+        "User write buffer:\n"
+        f"• depth: {wb['depth']} | flushes: {wb['flushes']} ({wb['rows_flushed']} rows, {wb['errors']} errors)\n"
+        f"• flush ms: last {wb['last_flush_ms']:.1f} | avg {wb['avg_flush_ms']:.1f} | max {wb['max_flush_ms']:.1f}"
+    )
+
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    days = 7
+    if context.args:
         try:
-            if update.message.reply_to_message:
-                r = update.message.reply_to_message
-                if r.photo:
-                    await context.bot.send_photo(uid, r.photo[-1].file_id, caption=args_text or None)
-                elif r.video:
-                    await context.bot.send_video(uid, r.video.file_id, caption=args_text or None)
-                elif r.document:
-                    await context.bot.send_document(uid, r.document.file_id, caption=args_text or None)
-                else:
-                    # fallback to text if unknown media
-                    await context.bot.send_message(uid, args_text or "(no content)")
-            else:
-                if args_text:
-                    await context.bot.send_message(uid, args_text)
-                else:
-                    await context.bot.send_message(uid, "(empty broadcast)")
-            sent += 1
-        except Exception:
-            failed += 1
-
-    # Gentle pacing to avoid flood limits
-    for uid in user_ids:
-        await send_to(uid)
-        await asyncio.sleep(0.05)
-
-    await update.effective_chat.send_message(f"Broadcast done. ✅ Sent: {sent} | ❌ Failed: {failed}")
+            days = max(1, min(90, int(context.args[0])))
+        except ValueError:
+            await update.effective_chat.send_message("Usage: /stats [days]")
+            return
+    # our own pending counters; other replicas' show up within STATS_FLUSH_INTERVAL
+    await stats_buffer.flush()
+    today = datetime.utcnow().date()
+    per_day, total_users = await get_daily_stats(today - timedelta(days=days - 1))
+    lines = [f"📊 Stats, last {days} day(s), UTC — {total_users} users all time"]
+    for offset in range(days):
+        day = today - timedelta(days=offset)
+        d = per_day.get(day, {})
+        line = (
+            f"{day:%m-%d}: +{d.get('new_users', 0)} users | verify {d.get('verify_passed', 0)}✓ "
+            f"{d.get('verify_failed', 0)}✗ | free stuff {d.get('free_stuff_taps', 0)}"
+        )
+        attempted = sum(v for k, v in d.items() if k.startswith("broadcast_"))
+        if attempted:
+            sent = d.get("broadcast_sent", 0)
+            line += f" | broadcast {sent}/{attempted} delivered ({sent / attempted:.0%})"
+        lines.append(line)
+    await update.effective_chat.send_message("\n".join(lines))
+
+
+async def cmd_latency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    await update.effective_chat.send_message(
+        f"Update handling latency ({BOT_MODE}):\n{update_latency.summary()}\n"
+        f"DB round trips per update: avg {db_round_trips.mean():.2f}"
+    )
+
+
+async def cmd_floodstats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await admin_guard(update, context):
+        return
+    st = flood_limiter.stats()
+    lines = [
+        f"• {action}: allowed {st['allowed'][action]} | throttled {st['throttled'][action]} "
+        f"| dropped {st['dropped'][action]}"
+        for action in st["allowed"]
+    ]
+    await update.effective_chat.send_message(
+        f"Flood control ({st['tracked']} buckets):\n" + "\n".join(lines)
+    )
 
 
 async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -336,7 +737,7 @@ async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def cmd_listchannels(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await admin_guard(update, context):
         return
-    channels = await list_channels()
+    channels = await settings_cache.channels()
     if not channels:
         await update.effective_chat.send_message("No required channels set.")
         return
@@ -352,6 +753,8 @@ async def cmd_addchannel(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     ident = context.args[0]
     await upsert_channel(ident)
+    settings_cache.invalidate("channels")
+    await resolve_channel_ids(context.bot)
     await update.effective_chat.send_message(f"✅ Added/updated required channel: {ident}")
 
 
@@ -363,6 +766,7 @@ async def cmd_removechannel(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     ident = context.args[0]
     await delete_channel(ident)
+    settings_cache.invalidate("channels")
     await update.effective_chat.send_message(f"✅ Removed required channel: {ident}")
 
 
@@ -386,6 +790,7 @@ async def cmd_addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.effective_chat.send_message("Provide a numeric user ID.")
         return
     await add_admin(uid)
+    settings_cache.invalidate("admins")
     await update.effective_chat.send_message(f"✅ Added admin {uid}")
 
 
@@ -401,47 +806,235 @@ async def cmd_removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.effective_chat.send_message("Provide a numeric user ID.")
         return
     await remove_admin(uid)
+    settings_cache.invalidate("admins")
     await update.effective_chat.send_message(f"✅ Removed admin {uid}")
 
 
 # ---------- App ----------
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Per-user token buckets in front of every handler, with separate budgets
+    for verify, free_stuff and everything else. Admins are exempt.
+    """
+    user = update.effective_user
+    # channel joins/leaves aren't the user talking to us and must never be dropped
+    if not user or update.chat_member:
+        return
+    action = classify(update)
+    if flood_limiter.allow(user.id, action) or await settings_cache.is_admin(user.id):
+        return
+    if update.callback_query:
+        flood_limiter.throttled[action] += 1
+        await update.callback_query.answer("Slow down a little 🙂")
+    else:
+        flood_limiter.dropped[action] += 1
+    raise ApplicationHandlerStop
+
+
+async def stamp_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _first_update_seen
+    # same context object is reused for every handler group of this update
+    context.received_at = time.perf_counter()
+    if not _first_update_seen:
+        _first_update_seen = True
+        logger.info(f"First update {time.perf_counter() - _process_started:.2f}s after launch")
+    context.db_round_trips = start_round_trip_count()
+
+
+async def track_last_seen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user and not update.chat_member:
+        user_buffer.touch(update.effective_user.id)
+
+
+async def mirror_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Keeps channel_members in step with joins and leaves in the required
+    channels (the bot must be an admin there to receive them).
+    """
+    change = update.chat_member
+    chat = change.chat
+    username = f"@{chat.username}".lower() if chat.username else None
+    idents = [ch for ch in await settings_cache.channels() if ch.lower() == username or ch == str(chat.id)]
+    if not idents:
+        return  # some other chat the bot administers
+    user_id = change.new_chat_member.user.id
+    user_buffer.set_membership(chat.id, user_id, is_member_status(change.new_chat_member), change.date)
+    for ident in idents:
+        member_cache.pop((user_id, ident))
+
+
+async def record_update_latency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    started = getattr(context, "received_at", None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        update_latency.observe(elapsed * 1000)
+        update_seconds.observe(elapsed)
+        db_round_trips.observe(context.db_round_trips[0])
+
+
+def on_settings_changed(what: str) -> None:
+    settings_cache.invalidate(what)
+    free_stuff_cache.invalidate(what)
+
+
+_process_started = time.perf_counter()
+_first_update_seen = False
+_settings_listener: asyncio.Task | None = None
+_metrics_server: asyncio.AbstractServer | None = None
+
+
+def cbq_label(update: Update) -> str:
+    action = (update.callback_query.data or "").partition(":")[0]
+    return f"cbq_handler:{action if action in ('verify', 'free_stuff', 'noop') else 'other'}"
+
+
+registry.register(Gauge("bot_db_pool_connections", "asyncpg pool connections by state", pool_stats, ("state",)))
+registry.register(Gauge("bot_user_buffer_depth", "User upserts waiting to be flushed",
+                        lambda: user_buffer.stats()["depth"]))
+registry.register(Gauge("bot_member_cache_size", "Membership cache entries", lambda: member_cache.stats()["size"]))
+registry.register(Gauge("bot_outbound_queue_depth", "Bot API calls waiting in the outbound scheduler",
+                        scheduler.depth, ("priority",)))
+registry.register(Gauge("bot_flood_tracked_users", "Users with a live flood-control bucket",
+                        lambda: flood_limiter.stats()["tracked"]))
+
+
 async def on_startup(app):
+    global _settings_listener, _metrics_server
+    started = time.perf_counter()
     await init_db()
+    if METRICS_PORT:
+        _metrics_server = await start_metrics_server(METRICS_PORT)
     await ensure_bootstrap_data(
         main_admin=MAIN_ADMIN_ID,
         secondary_admins=SECONDARY_ADMINS,
         required_channels=REQUIRED_CHANNELS,
     )
-    logger.info("Bot is up.")
+    user_buffer.start()
+    stats_buffer.start()
+    # in the background: one get_chat per '@name' channel, and only the first time
+    task_runner.spawn("resolve_channel_ids", resolve_channel_ids(app.bot))
+    # Other replicas tell us via NOTIFY when admins/channels change
+    _settings_listener = asyncio.create_task(listen_settings_changes(on_settings_changed))
+    # Sends running broadcasts, incl. ones interrupted by a crash or redeploy
+    dispatcher.start(app.bot)
+    if app.job_queue:
+        app.job_queue.run_repeating(
+            load_scheduled_broadcasts, interval=SCHEDULED_BROADCAST_SYNC_INTERVAL, first=0,
+            name="load_scheduled_broadcasts",
+        )
+    else:
+        logger.warning("No job queue (python-telegram-bot[job-queue]); scheduled broadcasts won't start")
+    logger.info(
+        f"Bot is up (replica {REPLICA_ID}): startup took {time.perf_counter() - started:.2f}s, "
+        f"{started - _process_started:.2f}s after launch."
+    )
+
+
+async def on_shutdown(app):
+    if _settings_listener:
+        _settings_listener.cancel()
+    # background jobs are cancelled; broadcasts resume on the next boot
+    # (or right away on another replica, since we give up our leases)
+    await dispatcher.stop()
+    await task_runner.stop_all()
+    await release_broadcast_shards(REPLICA_ID)
+    # final flush so no /start user is lost on redeploy
+    await user_buffer.stop()
+    await stats_buffer.stop()
+    if _metrics_server:
+        _metrics_server.close()
 
 
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        # times every Bot API call by method for /metrics (256 = PTB's default pool size)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        # global/per-chat limits, priorities and RetryAfter for every outbound call
+        .rate_limiter(scheduler)
+        # handle updates concurrently, but each user's updates in order
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    )
+    if CLUSTER_MODE:
+        # updates come from the Postgres queue; cluster.py runs the ingesting Updater
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("menu", cmd_menu))
-    app.add_handler(CommandHandler("add", cmd_add))
-    app.add_handler(CommandHandler("broadcast", cmd_broadcast))
+    app.add_handler(CommandHandler("start", timed(start)))
+    app.add_handler(CommandHandler("menu", timed(cmd_menu)))
+    app.add_handler(CommandHandler("add", timed(cmd_add)))
+    app.add_handler(CommandHandler("syncarchive", timed(cmd_syncarchive)))
+    app.add_handler(CommandHandler("broadcast", timed(cmd_broadcast)))
+    app.add_handler(CommandHandler("broadcasts", timed(cmd_broadcasts)))
+    app.add_handler(CommandHandler("audience", timed(cmd_audience)))
+    app.add_handler(CommandHandler("pausebroadcast", timed(cmd_pausebroadcast)))
+    app.add_handler(CommandHandler("resumebroadcast", timed(cmd_resumebroadcast)))
+    app.add_handler(CommandHandler("cancelbroadcast", timed(cmd_cancelbroadcast)))
 
     # scalability helpers
-    app.add_handler(CommandHandler("listchannels", cmd_listchannels))
-    app.add_handler(CommandHandler("addchannel", cmd_addchannel))
-    app.add_handler(CommandHandler("removechannel", cmd_removechannel))
-    app.add_handler(CommandHandler("listadmins", cmd_listadmins))
-    app.add_handler(CommandHandler("addadmin", cmd_addadmin))
-    app.add_handler(CommandHandler("removeadmin", cmd_removeadmin))
+    app.add_handler(CommandHandler("listchannels", timed(cmd_listchannels)))
+    app.add_handler(CommandHandler("addchannel", timed(cmd_addchannel)))
+    app.add_handler(CommandHandler("removechannel", timed(cmd_removechannel)))
+    app.add_handler(CommandHandler("listadmins", timed(cmd_listadmins)))
+    app.add_handler(CommandHandler("addadmin", timed(cmd_addadmin)))
+    app.add_handler(CommandHandler("removeadmin", timed(cmd_removeadmin)))
+    app.add_handler(CommandHandler("cachestats", timed(cmd_cachestats)))
+    app.add_handler(CommandHandler("stats", timed(cmd_stats)))
+    app.add_handler(CommandHandler("latency", timed(cmd_latency)))
+    app.add_handler(CommandHandler("floodstats", timed(cmd_floodstats)))
 
     # Callback queries
-    app.add_handler(CallbackQueryHandler(cbq_handler))
+    app.add_handler(CallbackQueryHandler(timed(cbq_handler, cbq_label)))
+    app.add_handler(ChatMemberHandler(timed(mirror_channel_member), ChatMemberHandler.CHAT_MEMBER))
+
+    # Album items sent to the bot by admins, for /broadcast
+    album_items = filters.PHOTO | filters.VIDEO | filters.Document.ALL | filters.AUDIO
+    app.add_handler(
+        MessageHandler(filters.ChatType.PRIVATE & filters.UpdateType.MESSAGE & album_items, remember_album_item),
+        group=1,
+    )
 
     # Optional confirmation keyword if you ever want to trigger it
     app.add_handler(MessageHandler(filters.Regex(r"^/confirm$"), echo_confirmation_for_owner_buttons))
 
+    # Flood control runs before anything else and may stop the update
+    app.add_handler(TypeHandler(Update, flood_guard), group=-2)
+    # Update-to-reply latency: stamped before every other group, recorded after
+    app.add_handler(TypeHandler(Update, stamp_update), group=-1)
+    # users.last_seen for the active=... broadcast filter, buffered and coalesced
+    app.add_handler(TypeHandler(Update, track_last_seen), group=99)
+    app.add_handler(TypeHandler(Update, record_update_latency), group=100)
+
     app.post_init = on_startup
+    app.post_shutdown = on_shutdown
     return app
 
 
 if __name__ == "__main__":
     application = build_app()
-    application.run_polling(close_loop=False)
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL")
+    # without it anyone who finds the URL can post updates, e.g. as an admin
+    # (this covers cluster ingestion too, which follows BOT_MODE)
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_SECRET")
+    if CLUSTER_MODE:
+        from cluster import run_cluster
+        asyncio.run(run_cluster(application))
+    elif BOT_MODE == "webhook":
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+            close_loop=False,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES, close_loop=False)
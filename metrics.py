@@ -0,0 +1,230 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from collections import deque
+from typing import Callable, Iterable
+
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats:
+    """Latency samples in ms: lifetime count/max plus a rolling window for percentiles."""
+
+    def __init__(self, window: int = 1000):
+        self._samples: deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        self._samples.append(ms)
+        self.count += 1
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p: float) -> float:
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        idx = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def summary(self) -> str:
+        return (
+            f"n={self.count} | p50 {self.percentile(50):.1f} ms | p95 {self.percentile(95):.1f} ms "
+            f"| p99 {self.percentile(99):.1f} ms | max {self.max_ms:.1f} ms"
+        )
+
+
+# ---------- Prometheus text format ----------
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.label_names = name, help, labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Gauge:
+    """Read at scrape time from `fn`, which returns a number or {label values: number}."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float | dict], labels: tuple[str, ...] = ()):
+        self.name, self.help, self.label_names, self.fn = name, help, labels, fn
+
+    def render(self) -> Iterable[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.debug(f"Gauge {self.name} unavailable: {e}")
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                yield f"{self.name}{_labels(self.label_names, labels)} {v}"
+        else:
+            yield f"{self.name} {value}"
+
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help, labels, buckets
+        # label values -> (per-bucket counts, sum, count)
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, seconds: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        idx = bisect.bisect_left(self.buckets, seconds)
+        if idx < len(self.buckets):
+            series[0][idx] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def mean(self, *labels) -> float:
+        _, total, count = self._series.get(labels, (None, 0.0, 0))
+        return total / count if count else 0.0
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = _labels(self.label_names, labels, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{le} {cumulative}"
+            le = _labels(self.label_names, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{le} {count}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.register(Histogram(
+    "bot_handler_seconds", "Time spent in each update handler", ("handler",)))
+update_seconds = registry.register(Histogram(
+    "bot_update_seconds", "Time from the first to the last handler group of an update"))
+db_acquire_seconds = registry.register(Histogram(
+    "bot_db_pool_acquire_seconds", "Time spent waiting for an asyncpg pool connection",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)))
+db_round_trips = registry.register(Histogram(
+    "bot_db_round_trips_per_update", "Postgres statements sent while handling one update",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)))
+api_seconds = registry.register(Histogram(
+    "bot_api_request_seconds", "Outbound Bot API call latency", ("method",)))
+api_errors = registry.register(Counter(
+    "bot_api_errors_total", "Outbound Bot API calls that raised", ("method", "error")))
+outbound_wait_seconds = registry.register(Histogram(
+    "bot_outbound_wait_seconds", "Time a Bot API call waited in the outbound scheduler", ("priority",)))
+outbound_retry_after = registry.register(Counter(
+    "bot_outbound_retry_after_total", "429 RetryAfter answers by priority class", ("priority",)))
+broadcast_messages = registry.register(Counter(
+    "bot_broadcast_messages_total", "Broadcast deliveries by outcome", ("outcome",)))
+
+# From the first handler group to the last, i.e. including our reply API calls
+update_latency = LatencyStats()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and errors of every Bot API call by method."""
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            api_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, method)
+
+
+def timed(callback: Callable, label: Callable[[object], str] | None = None) -> Callable:
+    """
+    Wraps a handler callback so its run time lands in bot_handler_seconds,
+    labelled with the callback's name or label(update).
+    """
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, label(update) if label else name)
+
+    return wrapper
+
+
+# ---------- HTTP endpoint ----------
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # headers are irrelevant
+        if len(request_line) >= 2 and request_line[0] == "GET" and request_line[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int) -> asyncio.AbstractServer:
+    """Serves GET /metrics in Prometheus text format on `port`."""
+    server = await asyncio.start_server(_serve, "0.0.0.0", port)
+    logger.info(f"Metrics on :{port}/metrics")
+    return server
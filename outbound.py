@@ -0,0 +1,203 @@
+"""
+One scheduler for every outbound Bot API call. It is plugged in as PTB's
+rate limiter, so context.bot and app.bot (broadcasts included) go through
+it; callers pick a priority class with rate_limit_args=BULK etc.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from cache import TTLCache
+from config import (
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_PRIVATE_CHAT_RATE,
+    OUTBOUND_GROUP_CHAT_RATE,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_MAX_RETRIES,
+    PER_USER_STATE_MAX,
+)
+from metrics import outbound_wait_seconds, outbound_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first. Interactive is the default for calls
+# made without rate_limit_args, i.e. every reply from a handler.
+INTERACTIVE = "interactive"
+BACKGROUND = "background"  # status message edits, archive sync
+BULK = "bulk"  # broadcasts
+PRIORITIES = {INTERACTIVE: 0, BACKGROUND: 1, BULK: 2}
+
+# Calls that post into a chat; Telegram's message limits apply to these only
+_POSTING = ("send", "copyMessage", "forwardMessage", "editMessage")
+
+
+class PriorityBucket:
+    """
+    Token bucket whose tokens go to the most urgent waiter first (FIFO
+    within a class), so bulk traffic queues behind interactive replies
+    instead of next to them. pause() holds everything back after a 429.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.depth = {priority: 0 for priority in PRIORITIES}
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: str) -> None:
+        now = time.monotonic()
+        if not self._waiters and now >= self._paused_until:
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES[priority], next(self._seq), future))
+        self.depth[priority] += 1
+        self.start()
+        self._wakeup.set()
+        try:
+            await future
+        finally:
+            self.depth[priority] -= 1
+
+    async def wait_unpaused(self) -> None:
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    async def _run(self) -> None:
+        while True:
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)  # cancelled while waiting
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                heapq.heappop(self._waiters)[2].set_result(None)
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class ChatLimiter:
+    """Per-chat limits as a generic cell rate algorithm: one timestamp per chat, no locks."""
+
+    def __init__(self, burst: int = OUTBOUND_CHAT_BURST, maxsize: int = PER_USER_STATE_MAX):
+        self.burst = burst
+        self._tat = TTLCache(maxsize)  # chat_id -> theoretical arrival time of its next message
+
+    def delay(self, chat_id: int | str, rate: float) -> float:
+        """Reserves the chat's next slot and returns how long to wait for it."""
+        now = time.monotonic()
+        interval = 1 / rate
+        tat = max(self._tat.get(chat_id, now), now)
+        wait = max(0.0, tat - (self.burst - 1) * interval - now)
+        self._tat.set(chat_id, tat + interval, ttl=tat + interval - now)
+        return wait
+
+
+class OutboundScheduler(BaseRateLimiter[str]):
+    """
+    Global and per-chat rate limits plus central RetryAfter handling. A 429
+    pauses every class. Interactive and background calls are then retried
+    here, up to `max_retries` times. Bulk calls re-raise right away, so the
+    broadcast loop can slow its own rate down (see broadcast.TokenBucket).
+    """
+
+    def __init__(
+        self,
+        rate: float = OUTBOUND_GLOBAL_RATE,
+        private_chat_rate: float = OUTBOUND_PRIVATE_CHAT_RATE,
+        group_chat_rate: float = OUTBOUND_GROUP_CHAT_RATE,
+        max_retries: int = OUTBOUND_MAX_RETRIES,
+    ):
+        self.bucket = PriorityBucket(rate)
+        self.chats = ChatLimiter()
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.max_retries = max_retries
+
+    async def initialize(self) -> None:
+        self.bucket.start()
+
+    async def shutdown(self) -> None:
+        await self.bucket.stop()
+
+    def depth(self) -> dict[str, int]:
+        return dict(self.bucket.depth)
+
+    async def _wait_turn(self, endpoint: str, chat_id: Any, priority: str) -> None:
+        if not endpoint.startswith(_POSTING):
+            await self.bucket.wait_unpaused()
+            return
+        if chat_id is not None:
+            # positive ids are private chats; groups, channels and '@names' get the group limit
+            private = isinstance(chat_id, int) and chat_id > 0
+            delay = self.chats.delay(chat_id, self.private_chat_rate if private else self.group_chat_rate)
+            if delay:
+                await asyncio.sleep(delay)
+        await self.bucket.acquire(priority)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: str | None,
+    ) -> Any:
+        priority = rate_limit_args if rate_limit_args in PRIORITIES else INTERACTIVE
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            await self._wait_turn(endpoint, data.get("chat_id"), priority)
+            outbound_wait_seconds.observe(time.perf_counter() - started, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                outbound_retry_after.inc(priority)
+                self.bucket.pause(float(e.retry_after))
+                if priority == BULK or attempt == self.max_retries:
+                    raise
+                logger.warning(f"{endpoint} hit a flood limit, all outbound calls paused for {e.retry_after}s")
+
+
+scheduler = OutboundScheduler()
@@ -0,0 +1,71 @@
+"""
+Posts recorded Telegram updates to a running webhook endpoint and reports
+how quickly the bot accepted them.
+
+    python replay_updates.py updates.jsonl --url http://localhost:8443/telegram
+
+Each line of the file is one Update as JSON (e.g. the `result` items of a
+getUpdates call). update_ids are rewritten so a file can be replayed many
+times. Update-to-reply latency is measured inside the bot: see /latency.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from config import PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+from metrics import LatencyStats
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def replay(updates: list[dict], url: str, secret: str | None, concurrency: int, repeat: int) -> None:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    stats = LatencyStats(window=len(updates) * repeat)
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    next_id = int(time.time())
+
+    async def post(client: httpx.AsyncClient, update: dict):
+        nonlocal errors, next_id
+        next_id += 1
+        body = dict(update, update_id=next_id)
+        async with sem:
+            started = time.perf_counter()
+            try:
+                resp = await client.post(url, json=body, headers=headers)
+                if resp.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+                return
+            stats.observe((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=30) as client:
+        await asyncio.gather(*[post(client, u) for _ in range(repeat) for u in updates])
+    elapsed = time.perf_counter() - started
+
+    total = len(updates) * repeat
+    print(f"Posted {total} updates in {elapsed:.2f}s ({total / elapsed:.1f} updates/s), {errors} errors")
+    print(f"Ack latency: {stats.summary()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="JSONL file with one recorded Update per line")
+    parser.add_argument("--url", default=f"http://localhost:{PORT}/{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(replay(load_updates(args.file), args.url, args.secret, args.concurrency, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import sys
+import time
+from typing import Awaitable, Coroutine, Hashable
+
+from telegram import Bot, Update
+from telegram.error import BadRequest
+from telegram.ext import BaseUpdateProcessor
+
+from outbound import BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+
+class StatusMessage:
+    """
+    A chat message that a background task keeps editing to report progress.
+    Edits are throttled to one per `min_interval` seconds; edit failures are
+    logged and otherwise ignored, progress reporting must never kill a job.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int, min_interval: float = 5.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self._last_edit = 0.0
+        self._last_text = ""
+
+    async def update(self, text: str, force: bool = False) -> None:
+        now = time.monotonic()
+        if text == self._last_text or (not force and now - self._last_edit < self.min_interval):
+            return
+        self._last_edit = now
+        self._last_text = text
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message_id, rate_limit_args=BACKGROUND
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.debug(f"Status message edit failed: {e}")
+        except Exception as e:
+            logger.debug(f"Status message edit failed: {e}")
+
+
+class TaskRunner:
+    """
+    Runs long admin operations off the update path. Tasks are keyed so the
+    same job never runs twice in one process. Deliberately not
+    Application.create_task: Application.stop() would wait for them.
+    """
+
+    def __init__(self):
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+
+    def is_running(self, key: Hashable) -> bool:
+        task = self._tasks.get(key)
+        return task is not None and not task.done()
+
+    def spawn(self, key: Hashable, coro: Coroutine) -> bool:
+        """Starts `coro` in the background. Returns False if `key` is already running."""
+        if self.is_running(key):
+            coro.close()
+            return False
+        task = asyncio.create_task(self._run_logged(key, coro))
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key, None) if self._tasks.get(key) is t else None)
+        return True
+
+    @staticmethod
+    async def _run_logged(key: Hashable, coro: Coroutine) -> None:
+        try:
+            await coro
+        except Exception:
+            logger.exception(f"Background task {key!r} crashed")
+
+    async def stop_all(self) -> None:
+        """Cancels everything on shutdown."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to `max_concurrent_updates` updates at once, but updates from
+    the same user (or chat, if there's no user) still run one after another,
+    in arrival order. An update waits for its user's turn before it takes one
+    of the slots, so a user sending many updates holds one slot, not all.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # the base class would take a slot before do_process_update runs, i.e.
+        # before the user's turn; its limit is lifted (so max_concurrent_updates
+        # reads as unbounded) and ours applied in do_process_update instead
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiting: dict[int, int] = {}
+
+    @staticmethod
+    def _key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+task_runner = TaskRunner()
@@ -0,0 +1,62 @@
+import asyncio
+
+from telegram import MessageId
+
+import broadcast
+
+
+class FakeBot:
+    """Answers copy_message(s) like the Bot API: with the ids of the new messages."""
+
+    def __init__(self):
+        self.next_id = 100
+
+    def _new_id(self) -> MessageId:
+        self.next_id += 1
+        return MessageId(self.next_id)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        return self._new_id()
+
+    async def copy_messages(self, chat_id, from_chat_id, message_ids, **kwargs):
+        return tuple(self._new_id() for _ in message_ids)
+
+
+def _run_shard(monkeypatch, payload: dict, user_ids: list[int]) -> list:
+    saved = []
+
+    async def pages(**kwargs):
+        yield user_ids
+
+    async def save_progress(job_id, shard_no, replica_id, cursor, sent, failed, unreachable, receipts):
+        saved.extend(receipts)
+        return {"status": "running", "sent": sent, "failed": failed, "skipped": len(unreachable), "total": len(user_ids)}
+
+    async def finish(*args):
+        return None
+
+    monkeypatch.setattr(broadcast, "iter_user_id_pages", pages)
+    monkeypatch.setattr(broadcast, "save_broadcast_progress", save_progress)
+    monkeypatch.setattr(broadcast, "finish_broadcast_shard", finish)
+    shard = {
+        "job_id": 1, "shard_no": 0, "payload": payload, "last_user_id": 0, "to_user_id": None,
+        "max_rate": None, "shards": 1, "chat_id": None, "status_message_id": None, "audience": {},
+    }
+    asyncio.run(broadcast.run_shard(FakeBot(), shard))
+    return saved
+
+
+def test_receipts_carry_message_ids(monkeypatch):
+    payload = {"kind": "copy", "from_chat_id": 42, "message_ids": [7]}
+    receipts = _run_shard(monkeypatch, payload, [1, 2, 3])
+    assert sorted(uid for uid, _, _ in receipts) == [1, 2, 3]
+    assert all(ids and len(ids) == 1 and error is None for _, ids, error in receipts)
+    # sends run concurrently, so which user got which id varies; each got its own
+    assert sorted(ids[0] for _, ids, _ in receipts) == [101, 102, 103]
+
+
+def test_album_receipts_carry_every_message_id(monkeypatch):
+    payload = {"kind": "copy", "from_chat_id": 42, "message_ids": [7, 8, 9]}
+    receipts = _run_shard(monkeypatch, payload, [1, 2])
+    assert sorted(uid for uid, _, _ in receipts) == [1, 2]
+    assert all(ids and len(ids) == 3 and error is None for _, ids, error in receipts)
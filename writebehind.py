@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import time
+from datetime import date, datetime
+
+from cache import TTLCache
+from config import (
+    USER_FLUSH_INTERVAL_MS,
+    USER_FLUSH_MAX_ROWS,
+    LAST_SEEN_RESOLUTION,
+    PER_USER_STATE_MAX,
+    STATS_FLUSH_INTERVAL,
+)
+from db import upsert_users_bulk, touch_users_bulk, upsert_channel_members_bulk, add_daily_stats
+
+logger = logging.getLogger(__name__)
+
+
+class UserWriteBuffer:
+    """
+    Write-behind buffer for user upserts. Pending rows are coalesced by
+    user_id and written as one multi-row upsert every `interval_ms` or as
+    soon as `max_rows` are waiting, whichever comes first. Activity for
+    users.last_seen goes the same way, at most once per user per
+    LAST_SEEN_RESOLUTION seconds, and so do channel joins/leaves for
+    channel_members.
+    """
+
+    def __init__(self, interval_ms: int = USER_FLUSH_INTERVAL_MS, max_rows: int = USER_FLUSH_MAX_ROWS):
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._pending: dict[int, tuple[int, str, datetime]] = {}
+        self._seen: dict[int, datetime] = {}
+        self._recently_seen = TTLCache(PER_USER_STATE_MAX)  # user_id -> True while last_seen is fresh enough
+        self._members: dict[tuple[int, int], tuple[int, int, bool, datetime]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        # metrics
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def add(self, user_id: int, first_name: str, joined_at: datetime) -> None:
+        prev = self._pending.get(user_id)
+        # keep the first joined_at we saw, but the latest name
+        self._pending[user_id] = (user_id, first_name, prev[2] if prev else joined_at)
+        if len(self._pending) >= self.max_rows:
+            self._wakeup.set()
+
+    def touch(self, user_id: int) -> None:
+        """Notes that the user is active; cheap enough to call on every update."""
+        if self._recently_seen.get(user_id):
+            return
+        self._recently_seen.set(user_id, True, ttl=LAST_SEEN_RESOLUTION)
+        self._seen[user_id] = datetime.utcnow()
+        if len(self._seen) >= self.max_rows:
+            self._wakeup.set()
+
+    def set_membership(self, chat_id: int, user_id: int, is_member: bool, at: datetime) -> None:
+        """Latest known membership of a user in a channel, as of `at`."""
+        key = (chat_id, user_id)
+        prev = self._members.get(key)
+        if prev is None or prev[3] <= at:
+            self._members[key] = (chat_id, user_id, is_member, at)
+        if len(self._members) >= self.max_rows:
+            self._wakeup.set()
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending) + len(self._seen) + len(self._members)
+
+    def _requeue(self, batch: dict[int, tuple[int, str, datetime]], seen: dict[int, datetime], members: dict) -> None:
+        # put rows back unless a newer update for the same user arrived meanwhile
+        for uid, row in batch.items():
+            self._pending.setdefault(uid, row)
+        for uid, when in seen.items():
+            self._seen.setdefault(uid, when)
+        for key, row in members.items():
+            self._members.setdefault(key, row)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending and not self._seen and not self._members:
+                return
+            batch, self._pending = self._pending, {}
+            seen, self._seen = self._seen, {}
+            members, self._members = self._members, {}
+            started = time.perf_counter()
+            try:
+                await upsert_users_bulk(list(batch.values()))
+                # after the upsert, so brand-new users exist to be touched
+                await touch_users_bulk(list(seen.items()))
+                await upsert_channel_members_bulk(list(members.values()))
+            except asyncio.CancelledError:
+                self._requeue(batch, seen, members)
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"User flush of {len(batch) + len(seen) + len(members)} rows failed, will retry: {e}")
+                self._requeue(batch, seen, members)
+                return
+            took = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.rows_flushed += len(batch) + len(seen) + len(members)
+            self.last_flush_ms = took
+            self.max_flush_ms = max(self.max_flush_ms, took)
+            self._total_flush_ms += took
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the flusher and writes whatever is still pending."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "errors": self.errors,
+            "last_flush_ms": self.last_flush_ms,
+            "avg_flush_ms": self._total_flush_ms / self.flushes if self.flushes else 0.0,
+            "max_flush_ms": self.max_flush_ms,
+        }
+
+
+class StatsBuffer:
+    """
+    Per-day counters for /stats. Counting is a dict update; the sums are
+    added to daily_stats in one statement every `interval` seconds.
+    """
+
+    def __init__(self, interval: float = STATS_FLUSH_INTERVAL):
+        self.interval = interval
+        self._counts: dict[tuple[date, str], int] = {}
+        self._task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+
+    def incr(self, metric: str, amount: int = 1) -> None:
+        key = (datetime.utcnow().date(), metric)
+        self._counts[key] = self._counts.get(key, 0) + amount
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._counts:
+                return
+            counts, self._counts = self._counts, {}
+            try:
+                await add_daily_stats([(day, metric, n) for (day, metric), n in counts.items()])
+            except asyncio.CancelledError:
+                self._requeue(counts)
+                raise
+            except Exception as e:
+                logger.warning(f"Stats flush failed, will retry: {e}")
+                self._requeue(counts)
+
+    def _requeue(self, counts: dict[tuple[date, str], int]) -> None:
+        # counts that arrived meanwhile are summed in
+        for key, n in counts.items():
+            self._counts[key] = self._counts.get(key, 0) + n
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+user_buffer = UserWriteBuffer()
+stats_buffer = StatsBuffer()